@@ -24,10 +24,77 @@ RAN_EMOJI_PROBABILITY = 0
 
 # 遗忘时间
 HISTORY_TIMEOUT = 600
+# 上下文 token 预算：系统提示 + 长期记忆 + 短期历史 + 本轮输入的总量（估算值）
+CONTEXT_TOKEN_BUDGET = 4000
+# 长期记忆最多占用的 token 数
+LONG_MEMORY_TOKEN_BUDGET = 600
+# 无论系统提示多长，至少留给短期历史的 token 数
+HISTORY_MIN_TOKENS = 500
+# 短期历史最多保留的消息条数（在 token 预算内按从新到旧取用）；更早的消息折叠进滚动摘要
+CONTEXT_MAX_MESSAGES = 24
+# 滚动摘要：每挤出多少条消息更新一次摘要，摘要最长字数
+SUMMARY_ENABLED = True
+SUMMARY_BATCH = 6
+SUMMARY_MAX_CHARS = 300
+
+# 常驻会话数上限（超出时淘汰最久未活动的会话）与过期会话的清理间隔（秒）
+SESSION_MAX = 1000
+SESSION_SWEEP_INTERVAL = 60
+# 短期记忆落盘（SQLite），重启后懒加载；设为 None 关闭
+SESSION_STORE_PATH = "data/sessions.sqlite3"
+
+# 图片缓存：内存中最多缓存的图片数与总大小（MB）
+IMAGE_CACHE_ITEMS = 256
+IMAGE_CACHE_MAX_MB = 64
+# 图片磁盘缓存目录（None 关闭磁盘层）
+IMAGE_CACHE_DIR = "data/image_cache"
+# 单张图片下载上限（MB），超过后中断下载
+IMAGE_MAX_DOWNLOAD_MB = 10
+# 发给视觉模型前的最长边（像素）与 JPEG 质量
+IMAGE_MAX_EDGE = 1024
+IMAGE_JPEG_QUALITY = 80
+# 重复图片描述缓存：感知哈希（dHash）汉明距离 ≤ 阈值视为同一张图，直接用缓存的文字描述代替图片
+IMAGE_CAPTION_ENABLED = True
+IMAGE_CAPTION_DISTANCE = 6
+IMAGE_CAPTION_MAX = 2000
+IMAGE_CAPTION_PATH = "data/image_captions.json"
+
+# 图源候选池：同一 (图源, 标签, 分级) 的查询结果缓存时长（秒）、池子数量上限、低于多少张时后台补货
+ACG_POOL_TTL = 1800
+ACG_POOL_MAX_KEYS = 200
+ACG_POOL_LOW_WATER = 10
+ACG_POOL_PATH = "data/acg_pool.json"
+
+# 回复判定的时间预算（秒），超时后使用默认决策
+REPLY_GATE_BUDGET = 6.0
+REPLY_GATE_DEFAULT = False
 
 # 控制台指令
 CMD_PREFIX = "/s"
 
+# 事件分发最大并发数（不同会话并行处理，同一会话内仍按顺序）
+DISPATCH_CONCURRENCY = 8
+
+# 突发合并：同一群聊在窗口内的多次回复触发只生成一次回复（秒，设为 0 关闭；私聊和被 @ 立即回复）
+BURST_WINDOW = 1.5
+# 从第一次触发起最多等待的时间（秒）
+BURST_MAX_WAIT = 5.0
+
+# 出站限速：整条连接的发送速率（条/秒）与突发上限
+OUTBOUND_GLOBAL_RATE = 2.0
+OUTBOUND_GLOBAL_BURST = 5
+# 出站限速：单个群 / 用户的发送速率（条/秒）与突发上限
+OUTBOUND_TARGET_RATE = 0.5
+OUTBOUND_TARGET_BURST = 3
+# 出站队列上限，满了之后发送方等待
+OUTBOUND_MAX_QUEUE = 200
+
+# 媒体引用缓存：记住 OneBot 为每张已发送网络图片（URL）记录的 file，再次发送同一 URL 时直接复用
+MEDIA_REGISTRY_PATH = "data/media_registry.json"
+MEDIA_REGISTRY_TTL = 3 * 86400
+# NapCat 与机器人在同一台机器时可直接发本地路径，否则本地图片转 base64 发送
+MEDIA_LOCAL_FILES = False
+
 # 表情包池(请自行配置)
 EMOJI_POOL = [
     "1188FB479104B480ED7CA1B9224309B8.jpg",#
@@ -125,6 +192,24 @@ PROMPT = [
 # llm state
 CURRENT_COMPLETION = "AIZEX"
 
+# 多模型对冲请求：上一个模型超过该延迟仍无结果时，并行启动 NAME 列表中的下一个模型
+# 可设为秒数，或 "p95"（按该模型近期 p95 耗时）；设为 None 则关闭对冲，只在失败后换下一个
+LLM_HEDGE_DELAY = "p95"
+# "p95" 模式下样本不足时使用的延迟（秒）
+LLM_HEDGE_DEFAULT_DELAY = 4.0
+
+# 模型健康状态（EWMA 耗时 / 错误率 / 熔断）持久化路径
+MODEL_HEALTH_PATH = "data/model_health.json"
+
+# 流式回复：边生成边按句子发送，首句生成后立即发出
+LLM_STREAM_REPLY = True
+# 首段最少字数
+STREAM_MIN_SEGMENT_CHARS = 4
+# 首段之后是否继续分段发送（False 时剩余内容生成完后一次发出）
+STREAM_FOLLOWUPS = False
+# 后续分段的最小发送间隔（秒）
+STREAM_FOLLOWUP_INTERVAL = 1.5
+
 LLM = {
     "DEEPSEEK-V3": {
         "KEY": os.getenv("DEEPSEEK"),
@@ -154,7 +239,8 @@ LLM = {
     "AIZEX": {
         "KEY": os.getenv("AIZEX"),
         "URL": "https://a1.aizex.me/v1",
-        "NAME": "gpt-4.1,gpt-5,gpt-4.1-mini,claude-4-sonnet"
+        "NAME": "gpt-4.1,gpt-5,gpt-4.1-mini,claude-4-sonnet",
+        "VISION": True  # 支持识图：触发回复的消息中的图片会发给模型
     },
     "Embedding": {
         "KEY": os.getenv("AIZEX"),
@@ -170,6 +256,17 @@ ALLOWED_GROUPS = [947805255, 1029247118, 964241282, 792513228, 2248341252, 79178
 FORTUNE_GROUPS = [1029247118, 964241282, 791782833]
 
 # Mem0 配置
+# 长期记忆向量库："milvus"（MEM0_CONFIG 中的远程库）或 "faiss"（本地，按用户分区存放在 FAISS_DIR）
+# 切换前可用 core.function_faiss_store.migrate_from_milvus 一次性迁移已有记忆
+LONG_MEMORY_BACKEND = "milvus"
+FAISS_DIR = "data/faiss"
+
+# 长期记忆检索缓存：每个用户的检索结果（写入新记忆时作废）与查询向量
+LONG_MEMORY_CACHE_ITEMS = 512
+LONG_MEMORY_CACHE_TTL = 300
+EMBEDDING_CACHE_ITEMS = 1024
+EMBEDDING_CACHE_TTL = 3600
+
 MEM0_CONFIG = {
     "llm": {
         "provider": "openai",
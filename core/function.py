@@ -2,7 +2,6 @@ from core.function_completion import *
 from core.function_long_turn_memory import *
 from core.function_cmd import *
 from core.function_session_memory import *
-import json
 
 # 随机文字池子
 def ran_rep_text_only():
@@ -32,7 +31,7 @@ def be_atted(event):
 
 
 # 条件回复(随机回复，被@，管理员发言，私聊)
-def rep(event, memory_manager):
+async def rep(event, memory_manager):
     if event.get("message_type") == "group" and event.get("group_id") not in config.ALLOWED_GROUPS:
         return False
 
@@ -41,7 +40,7 @@ def rep(event, memory_manager):
 
     try:
         session_id = calc_session_id(event)
-        return should_reply_langchain(event, memory_manager, session_id)
+        return await should_reply_langchain(event, memory_manager, session_id)
     except Exception as e:
         print(f"⚠️ [rep] NLP 调用异常: {e}")
         return False
@@ -61,36 +60,28 @@ def out(tip, content):
     print(f"----------\n{tip}\n{content}\n----------")
 
 
-# 导入最近十条聊天消息
-async def get_nearby_message(websocket, event, llm):
+# 导入最近十条聊天消息（原始 OneBot 消息，由 initialize_with_history 解析，不下载图片）
+async def get_nearby_message(client, event):
     try:
         msg_type = event.get("message_type")
         key = "group_id" if msg_type == "group" else "user_id"
         act = "get_group_msg_history" if msg_type == "group" else "get_friend_msg_history"
         current_id = event[key]
-        await websocket.send(json.dumps({
-            "action": act,
-            "params": {
-                key: current_id,
-                "message_seq": 0  # 为0时从最新消息开始抓取
-            }
-        }))
-        response = await websocket.recv()
-        data = json.loads(response)
-
-        res = []
+        # 通过 echo 关联响应，不会误收到其他事件
+        data = await client.call(act, {
+            key: current_id,
+            "message_seq": 0  # 为0时从最新消息开始抓取
+        })
+
         if data.get("status") == "ok":
-            messages = data.get("data").get("messages")[-config.MESSAGE_COUNT:]
-            for log in messages:
-                processed_msgs = process_single_message(log.get("message"), log.get("sender").get("nickname"), llm)
-                res.extend(processed_msgs)
-            return res
+            return data.get("data").get("messages")[-config.MESSAGE_COUNT:]
 
     except Exception as e:
         print("⚠️ 获取群聊消息时发生错误:", str(e))
 
 # 处理一条 CQ 消息，生成可直接塞进 handle_pool 的列表
-def process_single_message(message, nickname, llm):
+# 图片只保留引用 {"type": "image_ref", "url": ...}，真正构建视觉 prompt 时才下载
+def process_single_message(message, nickname):
     results = []
     if not message or not isinstance(message, list):
         out("⚠️ message 无效或为空", 400)
@@ -121,29 +112,13 @@ def process_single_message(message, nickname, llm):
             at_prompt += target_prompt
         # 图片
         elif log_type == "image":
-            if llm != config.LLM["AIZEX"]:
-                out("🛑 识图功能已关闭", 404)
-                continue
-
-            image_base64 = url_to_base64(data.get("url"))
-            if image_base64:
-                results.append({
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image_url",
-                            "image_url": {"url": image_base64}
-                        }
-                    ]
-                })
-            else:
-                results.append({
-                    "role": "user",
-                    "content": [{
-                        "type": "text",
-                        "text": "(系统提示: 图片获取失败)"
-                    }]
-                })
+            results.append({
+                "role": "user",
+                "content": [{
+                    "type": "image_ref",
+                    "url": data.get("url")
+                }]
+            })
 
     if text_body or at_prompt:
         # 昵称 + at 提示 + 冒号 + 文本
@@ -0,0 +1,196 @@
+import asyncio
+import json
+import os
+import random
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence
+
+import config
+
+
+Loader = Callable[[], Awaitable[List[str]]]
+
+
+# 图源查询的候选池键：标签与顺序无关
+def pool_key(provider: str, tags: Sequence[str], rating: Optional[str]) -> str:
+    return f"{provider}|{' '.join(sorted(t.lower() for t in tags))}|{rating or ''}"
+
+
+@dataclass
+# 预留的候选：竞速胜出后再 commit，落选的不消耗池子
+class Reservation:
+    key: str
+    url: Optional[str]
+    loader: Loader
+
+    def __bool__(self) -> bool:
+        return bool(self.url)
+
+
+# 图源查询结果池
+class ResultPool:
+    """
+    booru 一次查询返回一整页候选，原来只取一张就全部丢掉：
+    - 按 (图源, 标签, 分级) 缓存整页候选，TTL 内直接从内存随机抽取，不放回；过期后整池换成新结果
+    - 多图源竞速时用 reserve=True 只预留不取出，胜出的那个再 commit
+    - 剩余数量低于 low_water 时后台补货，补回来的候选去掉已经发过的
+    - 池子数量按最近使用淘汰，每个池子的候选数有上限
+    - 持久化到 JSON，重启后仍可用
+    """
+
+    def __init__(self, path: Optional[str] = None, ttl: float = 1800.0, max_pools: int = 200,
+                 max_items: int = 200, low_water: int = 10, max_seen: int = 500, save_interval: float = 60.0):
+        self._path = path
+        self._ttl = ttl
+        self._max_pools = max_pools
+        self._max_items = max_items
+        self._low_water = low_water
+        self._max_seen = max_seen
+        self._save_interval = save_interval
+        self._last_save = 0.0
+        self._dirty = False
+        self._pools: "OrderedDict[str, dict]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._stats = {"hits": 0, "misses": 0, "refills": 0, "remote_loads": 0, "load_failures": 0}
+        self.load()
+
+    def _expired(self, pool: dict) -> bool:
+        return time.time() - pool["fetched_at"] > self._ttl
+
+    # 用新查询结果更新池子（去掉已经发过的候选）
+    def _merge(self, key: str, urls: List[str]) -> dict:
+        pool = self._pools.get(key) or {"items": [], "seen": [], "fetched_at": 0.0}
+        seen = set(pool["seen"])
+        fresh = [u for u in dict.fromkeys(urls) if u and u not in seen]
+        if not fresh and urls:
+            # 这组标签的图都发过一轮了，重新开始
+            pool["seen"] = []
+            fresh = list(dict.fromkeys(u for u in urls if u))
+        # 过期的旧候选直接丢弃，否则 TTL 永远淘汰不掉它们
+        items = [] if self._expired(pool) else pool["items"]
+        known = set(items)
+        pool["items"] = (items + [u for u in fresh if u not in known])[-self._max_items:]
+        pool["fetched_at"] = time.time()
+
+        self._pools[key] = pool
+        self._pools.move_to_end(key)
+        while len(self._pools) > self._max_pools:
+            self._pools.popitem(last=False)
+        self._dirty = True
+        return pool
+
+    async def _load(self, key: str, loader: Loader) -> None:
+        self._stats["remote_loads"] += 1
+        try:
+            urls = await loader()
+        except Exception:
+            self._stats["load_failures"] += 1
+            raise
+        self._merge(key, urls or [])
+        self._maybe_save()
+
+    # 同一个池子同时只有一个远程查询
+    def _start_load(self, key: str, loader: Loader) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key, loader))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _t, k=key: self._inflight.pop(k, None))
+        return task
+
+    def _schedule_refill(self, key: str, loader: Loader) -> None:
+        if key in self._inflight:
+            return
+        self._stats["refills"] += 1
+        task = self._start_load(key, loader)
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    # 随机取一个候选（不放回）；池子为空或过期时先远程查询
+    async def pick(self, key: str, loader: Loader, reserve: bool = False):
+        """
+        :param reserve: True 时只预留不取出，返回 Reservation（取不到时为 None），需要 commit 才算用掉
+        """
+        pool = self._pools.get(key)
+        if pool is None or not pool["items"] or self._expired(pool):
+            self._stats["misses"] += 1
+            await asyncio.shield(self._start_load(key, loader))
+            pool = self._pools.get(key)
+        else:
+            self._stats["hits"] += 1
+
+        if not pool or not pool["items"]:
+            return None
+
+        self._pools.move_to_end(key)
+        url = random.choice(pool["items"])
+        if reserve:
+            return Reservation(key, url, loader)
+        self._take(key, url, loader)
+        return url
+
+    # 确认使用预留的候选
+    def commit(self, reservation: Reservation) -> str:
+        self._take(reservation.key, reservation.url, reservation.loader)
+        return reservation.url
+
+    def _take(self, key: str, url: str, loader: Loader) -> None:
+        pool = self._pools.get(key)
+        if pool is None:
+            return
+        if url in pool["items"]:
+            pool["items"].remove(url)
+        pool["seen"] = (pool["seen"] + [url])[-self._max_seen:]
+        self._dirty = True
+
+        if len(pool["items"]) <= self._low_water:
+            self._schedule_refill(key, loader)
+
+    def _maybe_save(self) -> None:
+        if self._path and time.time() - self._last_save >= self._save_interval:
+            self.save()
+
+    def save(self) -> None:
+        if not self._path or not self._dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+            tmp = self._path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self._pools, f, ensure_ascii=False)
+            os.replace(tmp, self._path)
+            self._last_save = time.time()
+            self._dirty = False
+        except Exception as e:
+            print(f"⚠️ 保存图源候选池失败: {e}")
+
+    def load(self) -> None:
+        if not self._path or not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            for key, pool in sorted(data.items(), key=lambda kv: kv[1].get("fetched_at", 0))[-self._max_pools:]:
+                self._pools[key] = pool
+            print(f"📂 已加载 {len(self._pools)} 个图源候选池")
+        except Exception as e:
+            print(f"⚠️ 读取图源候选池失败: {e}")
+
+    # 获取候选池统计信息（调试用）
+    def get_stats(self) -> dict:
+        picks = self._stats["hits"] + self._stats["misses"]
+        return {
+            **self._stats,
+            "pools": len(self._pools),
+            "candidates": sum(len(p["items"]) for p in self._pools.values()),
+            "hit_rate": self._stats["hits"] / picks if picks else 0.0,
+        }
+
+
+ACG_POOL = ResultPool(
+    path=config.ACG_POOL_PATH,
+    ttl=config.ACG_POOL_TTL,
+    max_pools=config.ACG_POOL_MAX_KEYS,
+    low_water=config.ACG_POOL_LOW_WATER,
+)
@@ -27,7 +27,7 @@ def _extract_cmd_text_from_event(msg_list, prefix="/s"):
     cmd_text = full[idx:].strip()
     return cmd_text or None
 
-def special_event(event):
+async def special_event(event):
     """
     仅 /s 开头被当作命令，其他一律当普通消息
     /s img <标签...> [r18]       或   /s 图片 <标签...> [r18]
@@ -79,7 +79,7 @@ def special_event(event):
                     tags.append(t)
 
             try:
-                url, src = fetch_acg_one(tags=tags, r18=r18)  # 默认非 r18；带 r18 才开启
+                url, src = await fetch_acg_one(tags=tags, r18=r18)  # 默认非 r18；带 r18 才开启
             except Exception as e:
                 url, src = None, None
 
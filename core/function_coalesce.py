@@ -0,0 +1,93 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+
+@dataclass
+# 一次突发内累积的触发
+class _Burst:
+    first: float
+    last: float
+    events: List[dict] = field(default_factory=list)
+    timer: Optional[asyncio.Task] = None
+
+
+# 会话级突发合并器
+class BurstCoalescer:
+    """
+    同一会话中相隔不超过 window 秒的多次回复触发合并为一次：
+    - 每来一次触发，等待窗口顺延 window 秒
+    - 从第一次触发起最多等待 max_wait 秒，避免持续刷屏时一直不回复
+    - 窗口结束后调用 on_fire(session_id, events)，events 按到达顺序排列
+    window <= 0 时不合并，每次触发立即回调。
+    immediate=True 的触发（私聊、被 @）不等窗口，连同窗口里已累积的触发立即回调。
+    """
+
+    def __init__(self, on_fire: Callable[[str, List[dict]], None], window: float = 1.5, max_wait: float = 5.0):
+        self._on_fire = on_fire
+        self._window = window
+        self._max_wait = max_wait
+        self._bursts: Dict[str, _Burst] = {}
+        self._triggers = 0
+        self._fires = 0
+
+    def add(self, session_id: str, event: dict, immediate: bool = False) -> None:
+        self._triggers += 1
+        burst = self._bursts.get(session_id)
+
+        if self._window <= 0 or immediate:
+            events = [event]
+            if burst is not None:
+                del self._bursts[session_id]
+                if burst.timer and not burst.timer.done():
+                    burst.timer.cancel()
+                events = burst.events + events
+            self._fire(session_id, events)
+            return
+
+        now = time.monotonic()
+        if burst is None:
+            burst = _Burst(first=now, last=now, events=[event])
+            self._bursts[session_id] = burst
+            burst.timer = asyncio.create_task(self._wait(session_id, burst))
+        else:
+            burst.events.append(event)
+            burst.last = now
+
+    async def _wait(self, session_id: str, burst: _Burst) -> None:
+        while True:
+            deadline = min(burst.last + self._window, burst.first + self._max_wait)
+            delay = deadline - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+
+        if self._bursts.get(session_id) is burst:
+            del self._bursts[session_id]
+        if len(burst.events) > 1:
+            print(f"🧩 会话 {session_id} 合并了 {len(burst.events)} 次触发")
+        self._fire(session_id, burst.events)
+
+    def _fire(self, session_id: str, events: List[dict]) -> None:
+        self._fires += 1
+        try:
+            self._on_fire(session_id, events)
+        except Exception as e:
+            print(f"⚠️ [coalescer] 会话 {session_id} 回调异常: {e}")
+
+    # 断线时丢弃未触发的合并窗口
+    def close(self) -> None:
+        for burst in self._bursts.values():
+            if burst.timer and not burst.timer.done():
+                burst.timer.cancel()
+        self._bursts.clear()
+
+    # 获取合并统计信息（调试用）
+    def get_stats(self) -> dict:
+        return {
+            "triggers": self._triggers,
+            "completions": self._fires,
+            "saved_calls": self._triggers - self._fires - sum(len(b.events) for b in self._bursts.values()),
+            "pending_sessions": len(self._bursts),
+        }
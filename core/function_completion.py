@@ -1,10 +1,15 @@
-import base64
-import requests
-import urllib.parse
+import asyncio
 import re
+import time
 import httpx
-from typing import Any, Dict, List
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Hashable, List
 import config
+from core.function_model_health import MODEL_HEALTH, is_timeout_error
+from core.function_image_fetch import IMAGE_FETCHER
+from core.function_image_caption import IMAGE_CAPTIONS
+from core.function_tokens import estimate_tokens, truncate_to_tokens
+from core.function_stats import percentile
 
 
 # 请求构建器
@@ -22,49 +27,61 @@ def build_params(type, event, content):
     return {**base, "message_type": msg_type, key: event[key]}
 
 
-# 图片转换（原样保留）
-def url_to_base64(url, timeout=(5, 20)):
+# 图片转换（异步 + 缓存，见 IMAGE_FETCHER）
+async def url_to_base64(url):
     """
     返回 data:<mime>;base64,... 或 None（出错时）。
-    timeout: (connect_timeout, read_timeout)
     """
-    try:
-        parsed = urllib.parse.urlparse(url)
-        origin = f"{parsed.scheme}://{parsed.netloc}"
-
-        headers = {
-            "User-Agent": ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                           "AppleWebKit/537.36 (KHTML, like Gecko) "
-                           "Chrome/120.0.0.0 Safari/537.36"),
-            "Accept": "image/*,*/*;q=0.8",
-            "Referer": origin,
-        }
+    return await IMAGE_FETCHER.fetch(url)
 
-        resp = requests.get(url, headers=headers, timeout=timeout, allow_redirects=True)
-        resp.raise_for_status()
-        content = resp.content
-
-        ct = (resp.headers.get("Content-Type") or "").split(";")[0].lower()
-        # 简易 magic bytes 嗅探
-        if not ct.startswith("image/"):
-            if content.startswith(b"\x89PNG\r\n\x1a\n"):
-                ct = "image/png"
-            elif content.startswith(b"\xff\xd8\xff"):
-                ct = "image/jpeg"
-            elif content[:6] in (b"GIF87a", b"GIF89a"):
-                ct = "image/gif"
-            else:
-                print(f"⚠️ 非图片 Content-Type: {resp.headers.get('Content-Type')}")
-                return None
-
-        b64 = base64.b64encode(content).decode("utf-8")
-        return f"data:{ct};base64,{b64}"
-
-    except requests.exceptions.RequestException as e:
-        print(f"⚠️ 请求失败: {e}")
-    except Exception as e:
-        print(f"⚠️ 处理异常: {e}")
-    return None
+
+# 当前模型是否支持识图
+def is_vision_llm(llm_config) -> bool:
+    return bool(llm_config.get("VISION"))
+
+
+# 把图片引用解析为发给模型的图片消息（只在构建 prompt 时调用）
+async def resolve_image_messages(urls, llm_config) -> list:
+    if not urls:
+        return []
+    if not is_vision_llm(llm_config):
+        print(f"🛑 识图功能已关闭，{len(urls)} 张图片未处理")
+        return []
+
+    parts = []
+    for data_url in await IMAGE_FETCHER.fetch_many(urls):
+        if not data_url:
+            parts.append({"type": "text", "text": "(系统提示: 图片获取失败)"})
+            continue
+
+        # 见过的表情包 / 梗图直接用文字描述，省掉一次多模态输入
+        if config.IMAGE_CAPTION_ENABLED:
+            h = await IMAGE_CAPTIONS.image_hash(data_url)
+            if h is not None:
+                caption = IMAGE_CAPTIONS.lookup(h, payload_bytes=len(data_url))
+                if caption:
+                    parts.append({"type": "text", "text": f"[图片: {caption}]"})
+                    continue
+                IMAGE_CAPTIONS.schedule_caption(h, data_url, lambda u: caption_image(u, llm_config))
+
+        parts.append({"type": "image_url", "image_url": {"url": data_url}})
+    return [HumanMessage(content=parts)]
+
+
+_CAPTION_PROMPT = "用一句不超过30字的中文描述这张图片：表情包说明人物/表情/情绪和图上的文字，其他图片说明主要内容。只输出描述本身。"
+
+
+# 用视觉模型为图片生成简短描述（供重复图片缓存）
+async def caption_image(data_url, llm_config):
+    names = [s.strip() for s in str(llm_config["NAME"]).split(",") if s.strip()]
+    name = MODEL_HEALTH.order(names)[0]
+    llm = create_chat_llm({**llm_config, "NAME": name})
+    msg = HumanMessage(content=[
+        {"type": "text", "text": _CAPTION_PROMPT},
+        {"type": "image_url", "image_url": {"url": data_url}},
+    ])
+    result = await llm.ainvoke([msg])
+    return str(result.content).strip()[:60]
 
 
 # ===== LangChain 相关 =====
@@ -74,6 +91,7 @@ from langchain_core.prompts import ChatPromptTemplate, FewShotChatMessagePromptT
 from langchain_core.caches import InMemoryCache
 from langchain_core.globals import set_llm_cache
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from langchain_core.runnables import ConfigurableFieldSpec
 from langchain_core.runnables.history import RunnableWithMessageHistory
 
 
@@ -143,11 +161,175 @@ HTTPX_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, k
 HTTPX_TIMEOUT = httpx.Timeout(connect=10.0, read=25.0, write=10.0, pool=10.0)
 HTTP_CLIENT = httpx.Client(limits=HTTPX_LIMITS, timeout=HTTPX_TIMEOUT, http2=True)
 
-# 模型配置
-_DEEPSEEK = config.LLM.get("DEEPSEEK-V3", {})
-_DEEPSEEK_NAME = _DEEPSEEK.get("NAME")
-_DEEPSEEK_URL = _DEEPSEEK.get("URL")
-_DEEPSEEK_KEY = _DEEPSEEK.get("KEY")
+# 全局共享的异步 Client（HTTP/2 多路复用，ainvoke 不再占用线程）
+HTTPX_ASYNC_LIMITS = httpx.Limits(max_connections=256, max_keepalive_connections=64, keepalive_expiry=30.0)
+HTTP_ASYNC_CLIENT = httpx.AsyncClient(limits=HTTPX_ASYNC_LIMITS, timeout=HTTPX_TIMEOUT, http2=True)
+
+
+# 补全耗时统计
+class LatencyStats:
+    def __init__(self, samples: int = 256):
+        self._samples: Deque[float] = deque(maxlen=samples)
+        self._in_flight = 0
+        self._peak_in_flight = 0
+        self._ok = 0
+        self._failed = 0
+
+    def begin(self) -> float:
+        self._in_flight += 1
+        self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+        return time.perf_counter()
+
+    def end(self, started: float, ok: bool = True) -> float:
+        self._in_flight -= 1
+        return self.observe(time.perf_counter() - started, ok)
+
+    # 直接记录一次已知耗时（不计入 in_flight）
+    def observe(self, elapsed: float, ok: bool = True) -> float:
+        if ok:
+            self._ok += 1
+            self._samples.append(elapsed)
+        else:
+            self._failed += 1
+        return elapsed
+
+    def snapshot(self) -> dict:
+        return {
+            "ok": self._ok,
+            "failed": self._failed,
+            "in_flight": self._in_flight,
+            "peak_in_flight": self._peak_in_flight,
+            "p50": percentile(self._samples, 0.50, 0.0),
+            "p95": percentile(self._samples, 0.95, 0.0),
+        }
+
+
+COMPLETION_STATS = LatencyStats()
+
+
+# LLM / chain 缓存注册表
+class ChainRegistry:
+    """
+    缓存构建代价较高的对象（ChatOpenAI、prompt、chain）
+    - key 标识对象用途，fingerprint 为构建它所依赖的配置
+    - fingerprint 变化（配置被修改）时丢弃旧对象并重建
+    """
+
+    def __init__(self):
+        self._entries: Dict[Hashable, tuple] = {}
+        self._hits = 0
+        self._builds = 0
+        self._build_seconds = 0.0
+        self._hit_seconds = 0.0
+
+    def get_or_build(self, key: Hashable, fingerprint: Hashable, factory: Callable[[], Any]) -> Any:
+        started = time.perf_counter()
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == fingerprint:
+            self._hits += 1
+            self._hit_seconds += time.perf_counter() - started
+            return entry[1]
+
+        obj = factory()
+        self._entries[key] = (fingerprint, obj)
+        self._builds += 1
+        self._build_seconds += time.perf_counter() - started
+        return obj
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    # 构建耗时 vs 命中耗时，即每次调用节省的准备开销
+    def get_stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self._hits,
+            "builds": self._builds,
+            "avg_build_ms": self._build_seconds / self._builds * 1000 if self._builds else 0.0,
+            "avg_hit_ms": self._hit_seconds / self._hits * 1000 if self._hits else 0.0,
+        }
+
+
+CHAIN_REGISTRY = ChainRegistry()
+
+# 流式回复：首段发送耗时 / 总耗时
+STREAM_FIRST_SEGMENT_STATS = LatencyStats()
+STREAM_TOTAL_STATS = LatencyStats()
+
+# 句子边界（强）与长句兜底切分点（弱）
+_SENTENCE_END = "。！？!?；;…\n"
+_SOFT_BREAK = "，,、 "
+
+
+# 流式句子切分器
+class SentenceStreamer:
+    """
+    把 token 流切成可以单独发送的句子段：
+    - 第一段凑够 min_chars 且遇到句子边界就立即发出
+    - 后续段：followups=True 时按 followup_interval 节流发送，否则留到 flush 一次发完
+    - 缓冲超过 max_chars 仍无句子边界时，在逗号等弱边界处切分
+    """
+
+    def __init__(self, emit, min_chars: int = 4, max_chars: int = 80,
+                 followups: bool = True, followup_interval: float = 1.0):
+        self._emit = emit
+        self._min_chars = min_chars
+        self._max_chars = max_chars
+        self._followups = followups
+        self._interval = followup_interval
+        self._buffer = ""
+        self._raw: List[str] = []
+        self._last_emit = 0.0
+        self.sent: List[str] = []
+
+    def _cut_index(self) -> int:
+        # 取最后一个句子边界：缓冲里已完整的句子一次带走
+        cut = max(self._buffer.rfind(ch) for ch in _SENTENCE_END)
+        if cut >= 0:
+            return cut + 1
+        if len(self._buffer) >= self._max_chars:
+            soft = max(self._buffer.rfind(ch) for ch in _SOFT_BREAK)
+            return soft + 1 if soft > 0 else len(self._buffer)
+        return -1
+
+    async def _send(self, text: str) -> None:
+        text = text.strip()
+        if not text:
+            return
+        self.sent.append(text)
+        self._last_emit = time.monotonic()
+        await self._emit(text)
+
+    async def feed(self, chunk: str) -> None:
+        if not chunk:
+            return
+        self._raw.append(chunk)
+        self._buffer += chunk
+
+        if self.sent and not self._followups:
+            return
+        if self.sent and time.monotonic() - self._last_emit < self._interval:
+            return
+
+        cut = self._cut_index()
+        if cut <= 0 or len(self._buffer[:cut].strip()) < self._min_chars:
+            return
+        segment, self._buffer = self._buffer[:cut], self._buffer[cut:]
+        await self._send(segment)
+
+    async def flush(self) -> None:
+        segment, self._buffer = self._buffer, ""
+        await self._send(segment)
+
+    # 完整回复原文（保留分段之间的空格 / 换行），用于写入记忆
+    @property
+    def text(self) -> str:
+        return "".join(self._raw).strip()
+
+
+# 判定模型配置（每次读取，便于运行时修改后自动重建）
+def _deepseek_config() -> Dict[str, Any]:
+    return config.LLM.get("DEEPSEEK-V3", {})
 
 
 # 提取当前消息文本
@@ -251,27 +433,34 @@ _PROMPT = ChatPromptTemplate.from_messages([
 
 # 供外部调用
 def create_chat_llm(llm_config):
-    """根据配置创建 ChatOpenAI 实例"""
-    return ChatOpenAI(
-        model=llm_config["NAME"],
-        api_key=llm_config["KEY"],
-        base_url=llm_config["URL"],
-        temperature=0.7,
-        timeout=15.0,
-        max_retries=0,
-        http_client=HTTP_CLIENT,
+    """根据配置获取 ChatOpenAI 实例（按 NAME/URL/KEY 缓存复用）"""
+    fingerprint = (llm_config["NAME"], llm_config["URL"], llm_config["KEY"])
+    return CHAIN_REGISTRY.get_or_build(
+        ("llm", llm_config["NAME"], llm_config["URL"]),
+        fingerprint,
+        lambda: ChatOpenAI(
+            model=llm_config["NAME"],
+            api_key=llm_config["KEY"],
+            base_url=llm_config["URL"],
+            temperature=0.7,
+            timeout=15.0,
+            max_retries=0,
+            http_client=HTTP_CLIENT,
+            http_async_client=HTTP_ASYNC_CLIENT,
+        ),
     )
 
-def _make_llm():
-    if not (_DEEPSEEK_NAME and _DEEPSEEK_URL and _DEEPSEEK_KEY):
+def _make_llm(cfg):
+    if not (cfg.get("NAME") and cfg.get("URL") and cfg.get("KEY")):
         raise RuntimeError("DEEPSEEK(OpenAI-compatible) 未配置：请在 config.LLM['DEEPSEEK-V3'] 中设置 NAME/URL/KEY")
     return ChatOpenAI(
-        model=_DEEPSEEK_NAME,
-        api_key=_DEEPSEEK_KEY,
-        base_url=_DEEPSEEK_URL,
+        model=cfg["NAME"],
+        api_key=cfg["KEY"],
+        base_url=cfg["URL"],
         temperature=0.0,
         timeout=12,
         max_retries=2,
+        http_async_client=HTTP_ASYNC_CLIENT,
     )
 
 
@@ -279,16 +468,21 @@ set_llm_cache(InMemoryCache())
 
 
 def _decision_chain():
-    llm = _make_llm()
-    return _PROMPT | llm.with_structured_output(Decision)
+    cfg = _deepseek_config()
+    return CHAIN_REGISTRY.get_or_build(
+        "decision",
+        (cfg.get("NAME"), cfg.get("URL"), cfg.get("KEY")),
+        lambda: _PROMPT | _make_llm(cfg).with_structured_output(Decision),
+    )
 
 
 # LangChain 判定
-def should_reply_langchain(event: Dict[str, Any], memory_manager, session_id: str) -> bool:
+async def should_reply_langchain(event: Dict[str, Any], memory_manager, session_id: str) -> bool:
     """
     - 图片-only：直接 False（仅依据分段 type）
     - 无文本：直接 False
-    - 其余交给 LangChain 结构化输出链
+    - 其余交给 LangChain 结构化输出链（异步，受 REPLY_GATE_BUDGET 限时）
+    - 超出时间预算：返回 REPLY_GATE_DEFAULT
     """
     try:
         if is_image_only_event(event):
@@ -305,8 +499,19 @@ def should_reply_langchain(event: Dict[str, Any], memory_manager, session_id: st
     ctx_lines = memory_manager.get_recent_dialog_lines(session_id, take_n=10, max_chars_per_line=240)
     ctx = "\n".join(ctx_lines) if ctx_lines else "（无）"
 
+    # 判定模型熔断中：直接使用默认决策
+    model_name = _deepseek_config().get("NAME") or "decision"
+    if not MODEL_HEALTH.acquire(model_name):
+        print(f"🔌 判定模型 {model_name} 熔断中，使用默认决策: {config.REPLY_GATE_DEFAULT}")
+        return bool(config.REPLY_GATE_DEFAULT)
+
+    started = time.perf_counter()
     try:
-        dec = _decision_chain().invoke({"ctx": ctx, "user_message": curr_text})
+        dec = await asyncio.wait_for(
+            _decision_chain().ainvoke({"ctx": ctx, "user_message": curr_text}),
+            timeout=config.REPLY_GATE_BUDGET,
+        )
+        MODEL_HEALTH.record_success(model_name, time.perf_counter() - started)
         should = bool(dec.should_reply)
         print("LC 判定:", {
             "should": should,
@@ -317,13 +522,55 @@ def should_reply_langchain(event: Dict[str, Any], memory_manager, session_id: st
         if (dec.confidence or 0) < 0.55 and dec.category != "QUESTION":
             return False
         return should
+    except asyncio.TimeoutError:
+        MODEL_HEALTH.record_failure(model_name, timeout=True)
+        print(f"⏱️ LangChain 判定超时({config.REPLY_GATE_BUDGET}s)，使用默认决策: {config.REPLY_GATE_DEFAULT}")
+        return bool(config.REPLY_GATE_DEFAULT)
+    except asyncio.CancelledError:
+        MODEL_HEALTH.record_cancelled(model_name)
+        raise
     except Exception as e:
+        MODEL_HEALTH.record_failure(model_name, timeout=is_timeout_error(e))
         print(f"⚠️ LangChain 判定失败: {e}")
         return False
 
 
-# 创建带短期+长期记忆的对话链
+_SUMMARY_PROMPT = ChatPromptTemplate.from_messages([
+    ("system",
+     "你负责维护一段群聊/私聊的滚动摘要。把【新对话】中值得记住的内容（话题、结论、约定、谁说了什么关键的话）"
+     "合并进【已有摘要】，删掉过时或无关紧要的细节。只输出新的摘要本身，不超过 {max_chars} 字。"),
+    ("human", "【已有摘要】\n{summary}\n\n【新对话】\n{dialog}"),
+])
+
+
+# 把被挤出窗口的对话折叠进滚动摘要（后台调用，用判定同款的便宜模型）
+async def summarize_dialog(summary: str, lines: List[str]) -> str:
+    cfg = _deepseek_config()
+    chain = CHAIN_REGISTRY.get_or_build(
+        "summary",
+        (cfg.get("NAME"), cfg.get("URL"), cfg.get("KEY")),
+        lambda: _SUMMARY_PROMPT | _make_llm(cfg),
+    )
+    result = await chain.ainvoke({
+        "summary": summary or "（无）",
+        "dialog": "\n".join(lines),
+        "max_chars": config.SUMMARY_MAX_CHARS,
+    })
+    text = result.content if hasattr(result, "content") else str(result)
+    return text.strip()[:config.SUMMARY_MAX_CHARS]
+
+
+# 创建带短期+长期记忆的对话链（按模型配置与提示词缓存复用）
 def create_chat_chain_with_memory(memory_manager, long_memory_pool, system_prompt, llm_config):
+    fingerprint = (llm_config["NAME"], llm_config["URL"], llm_config["KEY"], system_prompt, id(memory_manager))
+    return CHAIN_REGISTRY.get_or_build(
+        ("chat_chain", llm_config["NAME"], llm_config["URL"]),
+        fingerprint,
+        lambda: _build_chat_chain_with_memory(memory_manager, system_prompt, llm_config),
+    )
+
+
+def _build_chat_chain_with_memory(memory_manager, system_prompt, llm_config):
 
     llm = create_chat_llm(llm_config)
 
@@ -331,34 +578,50 @@ def create_chat_chain_with_memory(memory_manager, long_memory_pool, system_promp
     prompt = ChatPromptTemplate.from_messages([
         ("system", system_prompt),
         ("system", "【相关长期记忆】\n{long_memory}"),
+        ("system", "【更早的对话摘要】\n{summary}"),
         MessagesPlaceholder(variable_name="history"),
-        ("human", "{input}")
+        ("human", "{input}"),
+        MessagesPlaceholder(variable_name="images", optional=True),
     ])
 
     # 构建基础 chain
     chain = prompt | llm
 
-    # 包装成带短期记忆的 chain
+    # 包装成带短期记忆的 chain；history_budget 为本次请求留给历史的 token 预算（0 为不限）
     chain_with_history = RunnableWithMessageHistory(
         chain,
         memory_manager.get_history,
         input_messages_key="input",
         history_messages_key="history",
+        history_factory_config=[
+            ConfigurableFieldSpec(id="session_id", annotation=str, name="Session ID",
+                                  description="会话 ID", default="", is_shared=True),
+            ConfigurableFieldSpec(id="history_budget", annotation=int, name="History token budget",
+                                  description="历史消息的 token 预算", default=0, is_shared=True),
+        ],
     )
 
     return chain_with_history
 
-# 从长期记忆池获取相关记忆并格式化为文本
-def get_long_memory_text(long_memory_pool, user_id, query):
+# 从长期记忆池获取相关记忆并格式化为文本（max_tokens 限制总长度，按相关度顺序保留）
+async def get_long_memory_text(long_memory_pool, user_id, query, max_tokens=None):
 
     try:
-        mem_dic = long_memory_pool.get(user_id, query=query)
+        mem_dic = await long_memory_pool.aget(user_id, query=query)
         if not mem_dic or not isinstance(mem_dic, dict):
             return "（无）"
 
         lines = []
+        used = 0
         for key, val in mem_dic.items():
-            lines.append(f"• {key}: {val}")
+            line = f"• {key}: {val}"
+            if max_tokens is not None:
+                remaining = max_tokens - used
+                if remaining <= 0:
+                    break
+                line = truncate_to_tokens(line, remaining)
+                used += estimate_tokens(line) + 1
+            lines.append(line)
         return "\n".join(lines) if lines else "（无）"
     except Exception as e:
         print(f"⚠️ 获取长期记忆失败: {e}")
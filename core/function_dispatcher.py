@@ -0,0 +1,102 @@
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+from core.function_stats import percentile
+
+
+Job = Callable[[], Awaitable]
+
+
+@dataclass
+# 单个会话的任务通道
+class _SessionLane:
+    queue: Deque[Tuple[float, Job]] = field(default_factory=deque)
+    worker: Optional[asyncio.Task] = None
+    processed: int = 0
+    max_depth: int = 0
+
+
+# 按会话分发事件的调度器
+class SessionDispatcher:
+    """
+    - 同一会话内的任务按到达顺序串行执行
+    - 不同会话之间并行执行，总并发受 max_concurrency 限制
+    - 会话队列清空后 worker 自动退出，不常驻
+    """
+
+    def __init__(self, max_concurrency: int = 8, wait_samples: int = 256):
+        self._sem = asyncio.Semaphore(max_concurrency)
+        self._max_concurrency = max_concurrency
+        self._lanes: Dict[str, _SessionLane] = {}
+        self._waits: Deque[float] = deque(maxlen=wait_samples)
+        self._running = 0
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._max_wait = 0.0
+
+    # 投递任务（不阻塞主循环）
+    def submit(self, session_id: str, job: Job) -> None:
+        lane = self._lanes.get(session_id)
+        if lane is None:
+            lane = _SessionLane()
+            self._lanes[session_id] = lane
+
+        lane.queue.append((time.monotonic(), job))
+        lane.max_depth = max(lane.max_depth, len(lane.queue))
+        self._submitted += 1
+
+        if lane.worker is None or lane.worker.done():
+            lane.worker = asyncio.create_task(self._drain(session_id, lane))
+
+    async def _drain(self, session_id: str, lane: _SessionLane) -> None:
+        while lane.queue:
+            enqueued_at, job = lane.queue.popleft()
+            async with self._sem:
+                wait = time.monotonic() - enqueued_at
+                self._waits.append(wait)
+                self._max_wait = max(self._max_wait, wait)
+                self._running += 1
+                try:
+                    await job()
+                    self._completed += 1
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self._failed += 1
+                    print(f"⚠️ [dispatcher] 会话 {session_id} 任务异常: {e}")
+                finally:
+                    self._running -= 1
+                    lane.processed += 1
+
+        # 队列已空：回收会话通道（检查与删除之间没有 await，不会漏任务）
+        if self._lanes.get(session_id) is lane:
+            del self._lanes[session_id]
+
+    # 断线时取消所有未完成任务
+    async def close(self) -> None:
+        workers = [lane.worker for lane in self._lanes.values() if lane.worker and not lane.worker.done()]
+        for task in workers:
+            task.cancel()
+        if workers:
+            await asyncio.gather(*workers, return_exceptions=True)
+        self._lanes.clear()
+
+    # 获取调度统计信息（调试用）
+    def get_stats(self) -> dict:
+        return {
+            "max_concurrency": self._max_concurrency,
+            "running": self._running,
+            "active_sessions": len(self._lanes),
+            "queued": sum(len(lane.queue) for lane in self._lanes.values()),
+            "queue_depth": {sid: len(lane.queue) for sid, lane in self._lanes.items() if lane.queue},
+            "submitted": self._submitted,
+            "completed": self._completed,
+            "failed": self._failed,
+            "wait_p50": percentile(self._waits, 0.50, 0.0),
+            "wait_p95": percentile(self._waits, 0.95, 0.0),
+            "wait_max": self._max_wait,
+        }
@@ -0,0 +1,360 @@
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import faiss
+import numpy as np
+from mem0.vector_stores.base import VectorStoreBase
+
+from core.function_stats import percentile
+
+
+@dataclass
+# 检索结果（与 mem0 各向量库的 OutputData 字段一致）
+class OutputData:
+    id: str
+    score: Optional[float]
+    payload: Dict[str, Any]
+
+
+# 单个用户的分区：一个 faiss 索引 + 记录表
+class _Partition:
+    def __init__(self, index, records: Dict[int, dict], next_id: int):
+        self.index = index
+        self.records = records                      # faiss id -> {"id": uuid, "payload": {...}}
+        self.by_uuid = {r["id"]: fid for fid, r in records.items()}
+        self.next_id = next_id
+        self.dirty = False                          # 有修改还没写回磁盘
+
+
+# 本地 FAISS 向量库（mem0 VectorStoreBase 实现）
+class LocalFaissStore(VectorStoreBase):
+    """
+    代替远程 Milvus，检索和写入都不再走公网：
+    - 按 user_id 分区，每个用户一个索引文件（<user>.index）和记录文件（<user>.json）
+    - 常驻内存的分区数不超过 max_partitions，按最近使用淘汰（有未写回的修改时先写盘）
+    - 增量 insert / update / delete，每次修改后只重写该用户的分区文件；
+      批量写入（如迁移）时可用 deferred_saves() 推迟到结束时每个分区只写一次
+    - insert 遇到已存在的 id 时覆盖原记录，重复执行迁移不会产生重复记忆
+    - 内积（IP）检索，向量先做 L2 归一化，与原 Milvus 配置的度量一致
+    """
+
+    def __init__(self, path: str, collection_name: str = "qq_memory", embedding_model_dims: int = 3072,
+                 max_partitions: int = 64):
+        self.collection_name = collection_name
+        self._root = path
+        self._dir = os.path.join(path, collection_name)
+        self._dims = embedding_model_dims
+        self._max_partitions = max_partitions
+        self._defer_saves = False
+        self._lock = threading.RLock()
+        self._parts: "OrderedDict[str, _Partition]" = OrderedDict()
+        # 记忆 id -> 所在分区（delete / get / update 只给 id）
+        self._owner: Dict[str, str] = {}
+        self.create_col(collection_name, embedding_model_dims)
+
+    # ---------- 分区文件 ----------
+    @staticmethod
+    def _part_name(user_id: Optional[str]) -> str:
+        return re.sub(r"[^\w-]", "_", str(user_id)) if user_id else "_shared"
+
+    def _paths(self, name: str):
+        return os.path.join(self._dir, f"{name}.index"), os.path.join(self._dir, f"{name}.json")
+
+    def _load(self, name: str) -> _Partition:
+        part = self._parts.get(name)
+        if part is not None:
+            self._parts.move_to_end(name)
+            return part
+
+        index_path, meta_path = self._paths(name)
+        if os.path.exists(index_path) and os.path.exists(meta_path):
+            index = faiss.read_index(index_path)
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            records = {int(fid): r for fid, r in meta["records"].items()}
+            part = _Partition(index, records, meta["next_id"])
+        else:
+            part = _Partition(faiss.IndexIDMap2(faiss.IndexFlatIP(self._dims)), {}, 0)
+
+        self._parts[name] = part
+        # 淘汰最久未用的分区（当前分区在末尾，不会被淘汰）
+        while len(self._parts) > self._max_partitions:
+            old_name, old = next(iter(self._parts.items()))
+            if old.dirty:
+                self._write(old_name, old)
+            del self._parts[old_name]
+        return part
+
+    # 分区有修改：立即写盘，批量写入期间只做标记
+    def _save(self, name: str) -> None:
+        part = self._parts[name]
+        part.dirty = True
+        if not self._defer_saves:
+            self._write(name, part)
+
+    def _write(self, name: str, part: _Partition) -> None:
+        index_path, meta_path = self._paths(name)
+        faiss.write_index(part.index, index_path + ".tmp")
+        os.replace(index_path + ".tmp", index_path)
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"next_id": part.next_id, "records": part.records}, f, ensure_ascii=False)
+        os.replace(meta_path + ".tmp", meta_path)
+        part.dirty = False
+
+    # 把所有未写回的分区写盘
+    def flush(self) -> None:
+        with self._lock:
+            for name, part in self._parts.items():
+                if part.dirty:
+                    self._write(name, part)
+
+    # 块内的写入只在结束时每个分区写一次盘
+    @contextmanager
+    def deferred_saves(self):
+        with self._lock:
+            self._defer_saves = True
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._defer_saves = False
+                self.flush()
+
+    def _partition_names(self) -> List[str]:
+        if not os.path.isdir(self._dir):
+            return list(self._parts)
+        names = {f[:-5] for f in os.listdir(self._dir) if f.endswith(".json")}
+        return sorted(names | set(self._parts))
+
+    def _vectors(self, vectors) -> np.ndarray:
+        arr = np.asarray(vectors, dtype="float32").reshape(-1, self._dims)
+        arr = np.ascontiguousarray(arr)
+        faiss.normalize_L2(arr)
+        return arr
+
+    # ---------- VectorStoreBase ----------
+    def create_col(self, name, vector_size=None, distance=None):
+        with self._lock:
+            os.makedirs(self._dir, exist_ok=True)
+            self._owner.clear()
+            for part_name in self._partition_names():
+                _, meta_path = self._paths(part_name)
+                try:
+                    with open(meta_path, "r", encoding="utf-8") as f:
+                        for r in json.load(f)["records"].values():
+                            self._owner[r["id"]] = part_name
+                except FileNotFoundError:
+                    pass
+
+    def insert(self, vectors, payloads=None, ids=None):
+        payloads = payloads or [{} for _ in vectors]
+        ids = ids or [str(uuid.uuid4()) for _ in vectors]
+        arr = self._vectors(vectors)
+
+        groups: Dict[str, List[int]] = {}
+        for i, payload in enumerate(payloads):
+            groups.setdefault(self._part_name((payload or {}).get("user_id")), []).append(i)
+
+        with self._lock:
+            # 已存在的 id 视为覆盖：先删掉旧记录（可能在别的分区）
+            for vector_id in ids:
+                if vector_id in self._owner:
+                    self._delete_locked(vector_id)
+            for name, rows in groups.items():
+                part = self._load(name)
+                fids = np.arange(part.next_id, part.next_id + len(rows), dtype="int64")
+                part.index.add_with_ids(arr[rows], fids)
+                for fid, i in zip(fids.tolist(), rows):
+                    part.records[fid] = {"id": ids[i], "payload": payloads[i] or {}}
+                    part.by_uuid[ids[i]] = fid
+                    self._owner[ids[i]] = name
+                part.next_id += len(rows)
+                self._save(name)
+
+    def search(self, query, vectors=None, limit=5, filters=None):
+        # 新版 mem0 传 (query 文本, 向量)，旧版直接把向量作为 query 传入
+        vec = self._vectors(vectors if vectors is not None else query)
+        filters = dict(filters or {})
+        user_id = filters.pop("user_id", None)
+        names = [self._part_name(user_id)] if user_id else self._partition_names()
+
+        results: List[OutputData] = []
+        with self._lock:
+            for name in names:
+                part = self._load(name)
+                if part.index.ntotal == 0:
+                    continue
+                # 有额外过滤条件时多取一些再筛
+                k = min(part.index.ntotal, limit * (4 if filters else 1))
+                scores, fids = part.index.search(vec, k)
+                for score, fid in zip(scores[0].tolist(), fids[0].tolist()):
+                    rec = part.records.get(fid)
+                    if rec is None or any(rec["payload"].get(key) != val for key, val in filters.items()):
+                        continue
+                    results.append(OutputData(id=rec["id"], score=score, payload=rec["payload"]))
+
+        results.sort(key=lambda r: r.score, reverse=True)
+        return results[:limit]
+
+    def delete(self, vector_id):
+        with self._lock:
+            self._delete_locked(vector_id)
+
+    def _delete_locked(self, vector_id) -> None:
+        name = self._owner.pop(vector_id, None)
+        if name is None:
+            return
+        part = self._load(name)
+        fid = part.by_uuid.pop(vector_id, None)
+        if fid is not None:
+            part.index.remove_ids(np.array([fid], dtype="int64"))
+            part.records.pop(fid, None)
+            self._save(name)
+
+    def update(self, vector_id, vector=None, payload=None):
+        with self._lock:
+            name = self._owner.get(vector_id)
+            if name is None:
+                return
+            part = self._load(name)
+            fid = part.by_uuid[vector_id]
+            if payload is not None:
+                part.records[fid]["payload"] = payload
+            if vector is not None:
+                ids = np.array([fid], dtype="int64")
+                part.index.remove_ids(ids)
+                part.index.add_with_ids(self._vectors(vector), ids)
+            self._save(name)
+
+    def get(self, vector_id):
+        with self._lock:
+            name = self._owner.get(vector_id)
+            if name is None:
+                return None
+            part = self._load(name)
+            rec = part.records.get(part.by_uuid.get(vector_id))
+            return OutputData(id=vector_id, score=None, payload=rec["payload"]) if rec else None
+
+    def list_cols(self):
+        if not os.path.isdir(self._root):
+            return []
+        return [d for d in os.listdir(self._root) if os.path.isdir(os.path.join(self._root, d))]
+
+    def delete_col(self):
+        with self._lock:
+            self._parts.clear()
+            self._owner.clear()
+            shutil.rmtree(self._dir, ignore_errors=True)
+
+    def col_info(self):
+        with self._lock:
+            names = self._partition_names()
+            return {"name": self.collection_name, "partitions": len(names), "count": len(self._owner)}
+
+    def list(self, filters=None, limit=None):
+        filters = dict(filters or {})
+        user_id = filters.pop("user_id", None)
+        names = [self._part_name(user_id)] if user_id else self._partition_names()
+
+        items: List[OutputData] = []
+        with self._lock:
+            for name in names:
+                for rec in self._load(name).records.values():
+                    if any(rec["payload"].get(key) != val for key, val in filters.items()):
+                        continue
+                    items.append(OutputData(id=rec["id"], score=None, payload=rec["payload"]))
+                    if limit and len(items) >= limit:
+                        return [items]
+        # 与 mem0 的 Milvus 实现一致，外面再包一层列表
+        return [items]
+
+    def reset(self):
+        self.delete_col()
+        self.create_col(self.collection_name, self._dims)
+
+
+# 从现有 Milvus 集合一次性迁移到本地（向量取不到时用 embedder 重新计算）
+def migrate_from_milvus(source, target: LocalFaissStore, embedder=None, batch: int = 1000) -> int:
+    """
+    :param source: mem0 的 Milvus 向量库实例（MEMORY.vector_store）
+    :param target: 本地 FAISS 向量库
+    :param embedder: mem0 的 embedding 模型；Milvus 返回的数据不带向量时用它重新计算
+    :return: 迁移的记忆条数
+    """
+    # 用 query_iterator 分批读取：offset + limit 分页受 Milvus 16384 条上限限制
+    migrated = 0
+    it = source.client.query_iterator(
+        collection_name=source.collection_name,
+        batch_size=batch,
+        filter="",
+        output_fields=["id", "vectors", "metadata"],
+    )
+    # 整个迁移期间每个分区只在结束时写一次盘；已迁移过的 id 会被覆盖而不是重复插入
+    try:
+        with target.deferred_saves():
+            while True:
+                rows = it.next()
+                if not rows:
+                    break
+
+                vectors, payloads, ids = [], [], []
+                for row in rows:
+                    payload = row.get("metadata") or {}
+                    vector = row.get("vectors")
+                    if vector is None:
+                        if embedder is None:
+                            continue
+                        vector = embedder.embed(payload.get("data", ""), "add")
+                    vectors.append(vector)
+                    payloads.append(payload)
+                    ids.append(str(row["id"]))
+
+                if vectors:
+                    target.insert(vectors, payloads, ids)
+                    migrated += len(vectors)
+                print(f"📦 已迁移 {migrated} 条记忆")
+    finally:
+        it.close()
+    return migrated
+
+
+# 对比两个向量库的检索耗时与召回率（以 reference 的结果为基准）
+def compare_backends(reference, candidate, query_vectors, filters_list=None, k: int = 5) -> dict:
+    """
+    :param query_vectors: 查询向量列表（可以用真实用户消息经 embedder 得到）
+    :param filters_list: 与查询一一对应的过滤条件（如 {"user_id": "123"}），None 表示不过滤
+    :return: 两边的 p50 / p95 耗时（秒）与 candidate 的 recall@k
+    """
+    filters_list = filters_list or [None] * len(query_vectors)
+    ref_latency, cand_latency, recalls = [], [], []
+
+    for vector, filters in zip(query_vectors, filters_list):
+        started = time.perf_counter()
+        expected = reference.search("", vectors=vector, limit=k, filters=filters)
+        ref_latency.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        got = candidate.search("", vectors=vector, limit=k, filters=filters)
+        cand_latency.append(time.perf_counter() - started)
+
+        expected_ids = {r.id for r in expected}
+        if expected_ids:
+            recalls.append(len(expected_ids & {r.id for r in got}) / len(expected_ids))
+
+    return {
+        "queries": len(query_vectors),
+        "reference_p50": percentile(ref_latency, 0.5),
+        "reference_p95": percentile(ref_latency, 0.95),
+        "candidate_p50": percentile(cand_latency, 0.5),
+        "candidate_p95": percentile(cand_latency, 0.95),
+        "recall_at_k": sum(recalls) / len(recalls) if recalls else None,
+    }
@@ -1,8 +1,10 @@
+import asyncio
 import json
 import random
 from pathlib import Path
 from typing import List, Tuple
 from PIL import Image, ImageDraw, ImageFont
+from core.function_outbound import PRIORITY_PUSH
 
 # ===== 配置 =====
 
@@ -224,39 +226,33 @@ def drawing(theme: str = "random") -> Path:
 
 # 发送到群
 
-async def send_daily_fortune(websocket, group_id: int, theme: str = "random"):
+async def send_daily_fortune(outbound, group_id: int, theme: str = "random"):
     """
     向群聊发送每日运势
-    :param websocket: WebSocket 连接
+    :param outbound: 出站发送调度器
     :param group_id: 群号
     :param theme: 主题名称
     """
-    import json
-    import base64
-
     try:
         print(f"🎴 正在为群 {group_id} 生成运势卡片...")
 
-        # 生成运势卡片
-        img_path = drawing(theme)
-
-        # 读取图片
-        with open(img_path, 'rb') as f:
-            img_data = base64.b64encode(f.read()).decode('utf-8')
+        # 生成运势卡片（Pillow 绘图放到线程里，不阻塞事件循环）
+        img_path = await asyncio.to_thread(drawing, theme)
 
-        # 发送图片
-        await websocket.send(json.dumps({
-            "action": "send_msg",
-            "params": {
-                "message_type": "group",
-                "group_id": group_id,
-                "message": [
-                    {"type": "image", "data": {"file": f"base64://{img_data}"}}
-                ]
-            }
-        }))
+        # 发送图片（本地文件由调度器按 MEDIA_LOCAL_FILES 转为 base64 或 file 路径）
+        # 推送优先级最低，由调度器统一限速；整张图上传较慢，超时放宽到 30 秒
+        resp = await outbound.send_msg({
+            "message_type": "group",
+            "group_id": group_id,
+            "message": [
+                {"type": "image", "data": {"file": f"file://{img_path.resolve()}"}}
+            ]
+        }, priority=PRIORITY_PUSH, timeout=30)
 
-        print(f"✅ 已向群 {group_id} 发送运势卡片")
+        if resp.get("status") == "ok":
+            print(f"✅ 已向群 {group_id} 发送运势卡片")
+        else:
+            print(f"⚠️ 向群 {group_id} 发送运势失败: {resp.get('wording') or resp.get('message')}")
 
         # 清理临时文件
         try:
@@ -273,7 +269,7 @@ async def send_daily_fortune(websocket, group_id: int, theme: str = "random"):
 # 定时任务
 
 def setup_daily_fortune_scheduler(
-        websocket,
+        outbound,
         target_groups: List[int],
         push_hour: int = 8,
         push_minute: int = 0,
@@ -282,7 +278,7 @@ def setup_daily_fortune_scheduler(
     """
     设置每日运势定时推送
 
-    :param websocket: WebSocket 连接
+    :param outbound: 出站发送调度器
     :param target_groups: 目标群号列表
     :param push_hour: 推送小时（0-23）
     :param push_minute: 推送分钟（0-59）
@@ -290,7 +286,6 @@ def setup_daily_fortune_scheduler(
     """
     from apscheduler.schedulers.asyncio import AsyncIOScheduler
     from apscheduler.triggers.cron import CronTrigger
-    import asyncio
 
     scheduler = AsyncIOScheduler()
 
@@ -298,12 +293,10 @@ def setup_daily_fortune_scheduler(
         """每日运势推送任务"""
         print(f"🔮 开始推送每日运势...")
 
+        # 逐个群生成并发送：卡片用到时才渲染，不会一次把所有群的图都画出来；
+        # 发送节奏由出站调度器的令牌桶控制，这里不再 sleep
         for group_id in target_groups:
-            try:
-                await send_daily_fortune(websocket, group_id, theme)
-                await asyncio.sleep(3)  # 避免发送过快
-            except Exception as e:
-                print(f"⚠️ 向群 {group_id} 推送失败: {e}")
+            await send_daily_fortune(outbound, group_id, theme)
 
         print(f"✅ 每日运势推送完成")
 
@@ -0,0 +1,172 @@
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Sequence, Tuple, Union
+
+from core.function_stats import percentile
+
+
+# 每个候选者的胜负与耗时统计
+class RaceStats:
+    def __init__(self, samples: int = 128):
+        self._samples = samples
+        self._latency: Dict[str, Deque[float]] = {}
+        self._counters: Dict[str, Dict[str, int]] = {}
+
+    def _counter(self, name: str) -> Dict[str, int]:
+        c = self._counters.get(name)
+        if c is None:
+            c = {"launched": 0, "wins": 0, "losses": 0, "errors": 0}
+            self._counters[name] = c
+        return c
+
+    def record(self, name: str, field: str) -> None:
+        self._counter(name)[field] += 1
+
+    def record_latency(self, name: str, seconds: float) -> None:
+        samples = self._latency.get(name)
+        if samples is None:
+            samples = deque(maxlen=self._samples)
+            self._latency[name] = samples
+        samples.append(seconds)
+
+    # 近期耗时分位数；样本不足 min_samples 时返回 None
+    def percentile(self, name: str, p: float, min_samples: int = 10) -> Optional[float]:
+        samples = self._latency.get(name) or ()
+        if len(samples) < min_samples:
+            return None
+        return percentile(samples, p)
+
+    def get_stats(self) -> dict:
+        stats = {}
+        for name, c in self._counters.items():
+            stats[name] = {**c, "p50": self.percentile(name, 0.50, 1), "p95": self.percentile(name, 0.95, 1)}
+        return stats
+
+
+Delay = Union[None, float, Callable[[Any], Optional[float]]]
+
+
+# 对冲竞速
+async def hedged_race(
+        candidates: Sequence[Any],
+        run: Callable[[Any], Awaitable[Any]],
+        delay: Delay = None,
+        deadline: Optional[float] = None,
+        accept: Callable[[Any], bool] = bool,
+        stats: Optional[RaceStats] = None,
+        name: Callable[[Any], str] = str,
+        discard: Optional[Callable[[Any, Any], Any]] = None,
+) -> Tuple[Any, Any]:
+    """
+    按顺序启动候选者，返回第一个有效结果 (candidate, result)，其余全部取消。
+    :param delay: 上一个候选者启动后多少秒仍无结果就启动下一个；
+                  None 表示不对冲（仅在失败后启动下一个），0 表示全部同时启动；
+                  也可传入函数，按刚启动的候选者给出延迟
+    :param deadline: 总时限（秒），超时抛出 asyncio.TimeoutError
+    :param accept: 判断结果是否可用
+    :param discard: 同一轮内落选的有效结果交给它释放 discard(candidate, result)，可以是协程函数
+    同一轮内同时完成的多个有效结果，按 candidates 顺序取靠前者。
+    全部失败时抛出最后一个异常。
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    tasks: Dict[asyncio.Task, int] = {}
+    launched_at: Dict[int, float] = {}
+    next_idx = 0
+    last_launch = started
+    last_err: Optional[BaseException] = None
+
+    def _launch() -> None:
+        nonlocal next_idx, last_launch
+        idx = next_idx
+        next_idx += 1
+        last_launch = loop.time()
+        launched_at[idx] = last_launch
+        tasks[asyncio.create_task(run(candidates[idx]))] = idx
+        if stats:
+            stats.record(name(candidates[idx]), "launched")
+
+    def _hedge_delay() -> Optional[float]:
+        d = delay(candidates[next_idx - 1]) if callable(delay) else delay
+        if d is None:
+            return None
+        return max(0.0, d - (loop.time() - last_launch))
+
+    try:
+        while True:
+            if not tasks:
+                if next_idx >= len(candidates):
+                    break
+                _launch()
+            # 0 延迟：一次性全部启动
+            while next_idx < len(candidates) and _hedge_delay() == 0:
+                _launch()
+
+            timeout = _hedge_delay() if next_idx < len(candidates) else None
+            if deadline is not None:
+                remaining = deadline - (loop.time() - started)
+                if remaining <= 0:
+                    raise asyncio.TimeoutError(f"hedged_race 超过总时限 {deadline}s")
+                timeout = remaining if timeout is None else min(timeout, remaining)
+
+            done, _ = await asyncio.wait(tasks.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            # 没有结果：到了对冲时间，启动下一个
+            if not done:
+                if next_idx < len(candidates) and _hedge_delay() == 0:
+                    _launch()
+                continue
+
+            winners = []
+            for task in done:
+                idx = tasks.pop(task)
+                cand_name = name(candidates[idx])
+                if task.cancelled():
+                    continue
+                err = task.exception()
+                if err is not None:
+                    last_err = err
+                    if stats:
+                        stats.record(cand_name, "errors")
+                    continue
+                result = task.result()
+                if stats:
+                    stats.record_latency(cand_name, loop.time() - launched_at[idx])
+                if accept(result):
+                    winners.append((idx, result))
+                else:
+                    last_err = ValueError(f"{cand_name} 返回了无效结果")
+                    if stats:
+                        stats.record(cand_name, "errors")
+
+            if winners:
+                idx, result = min(winners, key=lambda w: w[0])
+                if stats:
+                    stats.record(name(candidates[idx]), "wins")
+                    for other, _ in winners:
+                        if other != idx:
+                            stats.record(name(candidates[other]), "losses")
+                    for other in tasks.values():
+                        stats.record(name(candidates[other]), "losses")
+                if discard:
+                    for other, other_result in winners:
+                        if other == idx:
+                            continue
+                        try:
+                            released = discard(candidates[other], other_result)
+                            if asyncio.iscoroutine(released):
+                                await released
+                        except Exception as e:
+                            print(f"⚠️ 释放落选结果失败 {name(candidates[other])}: {e}")
+                return candidates[idx], result
+
+            # 有候选者失败：不再等待对冲延迟，立即补位
+            if next_idx < len(candidates):
+                _launch()
+
+        raise last_err or RuntimeError("没有可用的候选者")
+    finally:
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
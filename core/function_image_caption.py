@@ -0,0 +1,175 @@
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional, Set
+
+from PIL import Image
+import config
+
+
+# dHash：缩成 (size+1)×size 灰度图，比较相邻像素明暗，得到 size*size 位指纹
+def dhash(content: bytes, size: int = 8) -> int:
+    with Image.open(io.BytesIO(content)) as img:
+        img.seek(0)
+        gray = img.convert("L").resize((size + 1, size), Image.LANCZOS)
+        pixels = list(gray.getdata())
+
+    bits = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return bits
+
+
+def _data_url_bytes(data_url: str) -> bytes:
+    return base64.b64decode(data_url.split(",", 1)[1])
+
+
+# 感知哈希 -> 图片描述 缓存
+class CaptionCache:
+    """
+    反复出现的表情包 / 梗图只让视觉模型看一次：
+    - 用 dHash 识别视觉上相同的图片，汉明距离 ≤ max_distance 视为同一张
+    - 第一次出现时照常发图，同时后台生成一句简短描述存起来
+    - 之后再出现直接以文字描述进入 prompt，不再附带 base64
+    - 条目数有上限（按最近使用淘汰），持久化到 JSON
+    """
+
+    def __init__(self, path: Optional[str] = None, max_entries: int = 2000,
+                 max_distance: int = 6, save_interval: float = 60.0):
+        self._path = path
+        self._max_entries = max_entries
+        self._max_distance = max_distance
+        self._save_interval = save_interval
+        self._last_save = 0.0
+        self._dirty = False
+        self._entries: "OrderedDict[int, dict]" = OrderedDict()
+        self._hash_of: "OrderedDict[str, int]" = OrderedDict()
+        self._pending: Set[int] = set()
+        self._stats = {"hits": 0, "misses": 0, "captions_generated": 0,
+                       "caption_failures": 0, "payload_bytes_saved": 0}
+        self.load()
+
+    # 计算（并缓存）图片的感知哈希
+    async def image_hash(self, data_url: str) -> Optional[int]:
+        key = hashlib.sha1(data_url.encode("ascii", "ignore")).hexdigest()
+        h = self._hash_of.get(key)
+        if h is not None:
+            self._hash_of.move_to_end(key)
+            return h
+        try:
+            h = await asyncio.to_thread(lambda: dhash(_data_url_bytes(data_url)))
+        except Exception as e:
+            print(f"⚠️ 计算图片指纹失败: {e}")
+            return None
+        self._hash_of[key] = h
+        while len(self._hash_of) > 1024:
+            self._hash_of.popitem(last=False)
+        return h
+
+    # 查找相同或近似图片的描述
+    def lookup(self, h: int, payload_bytes: int = 0) -> Optional[str]:
+        entry_hash = h if h in self._entries else None
+        if entry_hash is None and self._max_distance > 0:
+            best = self._max_distance + 1
+            for other in self._entries:
+                d = (h ^ other).bit_count()
+                if d < best:
+                    best, entry_hash = d, other
+
+        if entry_hash is None:
+            self._stats["misses"] += 1
+            return None
+
+        entry = self._entries[entry_hash]
+        entry["hits"] += 1
+        entry["last_used"] = time.time()
+        self._entries.move_to_end(entry_hash)
+        self._dirty = True
+        self._stats["hits"] += 1
+        self._stats["payload_bytes_saved"] += payload_bytes
+        return entry["caption"]
+
+    def put(self, h: int, caption: str) -> None:
+        self._entries[h] = {"caption": caption, "hits": 0, "last_used": time.time()}
+        self._entries.move_to_end(h)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+        self._dirty = True
+        self._maybe_save()
+
+    # 后台为新图片生成描述（同一指纹只生成一次）
+    def schedule_caption(self, h: int, data_url: str,
+                         captioner: Callable[[str], Awaitable[Optional[str]]]) -> None:
+        if h in self._pending or h in self._entries:
+            return
+        self._pending.add(h)
+
+        async def _run():
+            try:
+                caption = await captioner(data_url)
+                if caption:
+                    self.put(h, caption.strip())
+                    self._stats["captions_generated"] += 1
+                    print(f"🏷️ 新图片描述: {caption.strip()}")
+            except Exception as e:
+                self._stats["caption_failures"] += 1
+                print(f"⚠️ 生成图片描述失败: {e}")
+            finally:
+                self._pending.discard(h)
+
+        asyncio.create_task(_run())
+
+    def _maybe_save(self) -> None:
+        if self._path and time.time() - self._last_save >= self._save_interval:
+            self.save()
+
+    def save(self) -> None:
+        if not self._path or not self._dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+            data = {format(h, "016x"): entry for h, entry in self._entries.items()}
+            tmp = self._path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp, self._path)
+            self._last_save = time.time()
+            self._dirty = False
+        except Exception as e:
+            print(f"⚠️ 保存图片描述缓存失败: {e}")
+
+    def load(self) -> None:
+        if not self._path or not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            items = sorted(data.items(), key=lambda kv: kv[1].get("last_used", 0))
+            for hex_hash, entry in items[-self._max_entries:]:
+                self._entries[int(hex_hash, 16)] = entry
+            print(f"📂 已加载 {len(self._entries)} 条图片描述")
+        except Exception as e:
+            print(f"⚠️ 读取图片描述缓存失败: {e}")
+
+    # 获取缓存统计信息（调试用）
+    def get_stats(self) -> dict:
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            **self._stats,
+            "entries": len(self._entries),
+            "hit_rate": self._stats["hits"] / lookups if lookups else 0.0,
+        }
+
+
+IMAGE_CAPTIONS = CaptionCache(
+    path=config.IMAGE_CAPTION_PATH,
+    max_entries=config.IMAGE_CAPTION_MAX,
+    max_distance=config.IMAGE_CAPTION_DISTANCE,
+)
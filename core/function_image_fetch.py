@@ -0,0 +1,323 @@
+import asyncio
+import base64
+import hashlib
+import io
+import os
+import time
+import urllib.parse
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from PIL import Image
+import config
+
+
+# QQ 图片链接中每次都会变化的鉴权参数，不参与缓存键
+_VOLATILE_PARAMS = {"rkey"}
+
+_HEADERS = {
+    "User-Agent": ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+                   "AppleWebKit/537.36 (KHTML, like Gecko) "
+                   "Chrome/120.0.0.0 Safari/537.36"),
+    "Accept": "image/*,*/*;q=0.8",
+}
+
+
+# 去掉易变参数后的 URL 作为缓存键
+def _url_key(url: str) -> str:
+    parsed = urllib.parse.urlparse(url)
+    query = [(k, v) for k, v in urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)
+             if k not in _VOLATILE_PARAMS]
+    return urllib.parse.urlunparse(parsed._replace(query=urllib.parse.urlencode(query)))
+
+
+# 简易 magic bytes 嗅探
+def sniff_image_type(content: bytes, content_type: str = "") -> Optional[str]:
+    ct = (content_type or "").split(";")[0].lower()
+    if ct.startswith("image/"):
+        return ct
+    if content.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if content.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if content[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if content[:4] == b"RIFF" and content[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+# 异步图片获取器（内容寻址缓存）
+class ImageFetcher:
+    """
+    - 内存 LRU：URL 键 -> 内容哈希 -> data URL；不同 URL 指向同一内容时共享一份
+    - 可选磁盘层：重启后仍可命中，按文件数上限淘汰最旧的
+    - single-flight：同一 URL 的并发请求只下载一次
+    - fetch_many 并发下载多图消息
+    - 流式下载，超过 max_download_bytes 或不是图片时提前中断
+    - 下载后按 max_edge / quality 缩放并重新编码，减小发给视觉模型的请求体
+    """
+
+    def __init__(
+            self,
+            max_items: int = 256,
+            max_bytes: int = 64 * 1024 * 1024,
+            disk_dir: Optional[str] = None,
+            disk_items: int = 2000,
+            timeout: httpx.Timeout = httpx.Timeout(connect=5.0, read=20.0, write=5.0, pool=5.0),
+            max_download_bytes: int = 10 * 1024 * 1024,
+            max_edge: int = 1024,
+            quality: int = 80,
+    ):
+        self._max_download_bytes = max_download_bytes
+        self._max_edge = max_edge
+        self._quality = quality
+        self._max_items = max_items
+        self._max_bytes = max_bytes
+        self._disk_dir = disk_dir
+        self._disk_items = disk_items
+        self._client = httpx.AsyncClient(timeout=timeout, follow_redirects=True, headers=_HEADERS)
+        self._urls: "OrderedDict[str, str]" = OrderedDict()
+        self._blobs: "OrderedDict[str, str]" = OrderedDict()
+        self._blob_bytes = 0
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._disk_writes = 0
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "joined": 0,
+                       "failures": 0, "aborted": 0, "bytes_downloaded": 0, "bytes_original": 0, "bytes_encoded": 0,
+                       "encode_seconds": 0.0}
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    # ---------- 内存层 ----------
+    def _memory_get(self, key: str) -> Optional[str]:
+        digest = self._urls.get(key)
+        if digest is None:
+            return None
+        data_url = self._blobs.get(digest)
+        if data_url is None:
+            del self._urls[key]
+            return None
+        self._urls.move_to_end(key)
+        self._blobs.move_to_end(digest)
+        return data_url
+
+    def _memory_put(self, key: str, digest: str, data_url: str) -> None:
+        self._urls[key] = digest
+        self._urls.move_to_end(key)
+        if digest not in self._blobs:
+            self._blobs[digest] = data_url
+            self._blob_bytes += len(data_url)
+        self._blobs.move_to_end(digest)
+
+        while self._blobs and (len(self._blobs) > self._max_items or self._blob_bytes > self._max_bytes):
+            _, old = self._blobs.popitem(last=False)
+            self._blob_bytes -= len(old)
+        while len(self._urls) > self._max_items * 4:
+            self._urls.popitem(last=False)
+
+    # ---------- 磁盘层 ----------
+    def _ref_path(self, key: str) -> str:
+        return os.path.join(self._disk_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".ref")
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self._disk_dir, digest + ".img")
+
+    def _disk_get(self, key: str) -> Optional[Tuple[str, str]]:
+        try:
+            with open(self._ref_path(key), "r", encoding="utf-8") as f:
+                digest, mime = f.read().split()
+            with open(self._blob_path(digest), "rb") as f:
+                content = f.read()
+            return digest, f"data:{mime};base64,{base64.b64encode(content).decode('utf-8')}"
+        except (OSError, ValueError):
+            return None
+
+    # content 为 None 时只写 URL 键到内容的引用（内容已经在缓存里）
+    def _disk_put(self, key: str, digest: str, mime: str, content: Optional[bytes]) -> None:
+        try:
+            blob = self._blob_path(digest)
+            if not os.path.exists(blob):
+                if content is None:
+                    return
+                with open(blob + ".tmp", "wb") as f:
+                    f.write(content)
+                os.replace(blob + ".tmp", blob)
+            with open(self._ref_path(key), "w", encoding="utf-8") as f:
+                f.write(f"{digest} {mime}")
+            self._disk_writes += 1
+            if self._disk_writes % 50 == 0:
+                self._disk_prune()
+        except OSError as e:
+            print(f"⚠️ 写入图片磁盘缓存失败: {e}")
+
+    def _disk_prune(self) -> None:
+        files = [os.path.join(self._disk_dir, n) for n in os.listdir(self._disk_dir)]
+        blobs = sorted((p for p in files if p.endswith(".img")), key=os.path.getmtime)
+        for path in blobs[:max(0, len(blobs) - self._disk_items)]:
+            os.remove(path)
+        refs = sorted((p for p in files if p.endswith(".ref")), key=os.path.getmtime)
+        for path in refs[:max(0, len(refs) - self._disk_items * 2)]:
+            os.remove(path)
+
+    # ---------- 下载 ----------
+    async def _download(self, url: str) -> Optional[Tuple[str, str, bytes]]:
+        """流式下载：声明或实际大小超过上限、开头不是图片数据时立即中断"""
+        parsed = urllib.parse.urlparse(url)
+        headers = {"Referer": f"{parsed.scheme}://{parsed.netloc}"}
+        async with self._client.stream("GET", url, headers=headers) as resp:
+            resp.raise_for_status()
+            content_type = resp.headers.get("Content-Type") or ""
+
+            declared = resp.headers.get("Content-Length")
+            if declared and declared.isdigit() and int(declared) > self._max_download_bytes:
+                print(f"⚠️ 图片过大（{int(declared) // 1024} KB），放弃下载")
+                self._stats["aborted"] += 1
+                return None
+
+            buf = bytearray()
+            mime = None
+            async for chunk in resp.aiter_bytes():
+                buf.extend(chunk)
+                self._stats["bytes_downloaded"] += len(chunk)
+                if len(buf) > self._max_download_bytes:
+                    print(f"⚠️ 图片超过 {self._max_download_bytes // 1024} KB，中断下载")
+                    self._stats["aborted"] += 1
+                    return None
+                # 拿到足够的头部字节后立刻判断是不是图片
+                if mime is None and len(buf) >= 16:
+                    mime = sniff_image_type(bytes(buf[:16]), content_type)
+                    if mime is None:
+                        print(f"⚠️ 非图片 Content-Type: {content_type}")
+                        self._stats["aborted"] += 1
+                        return None
+
+        content = bytes(buf)
+        mime = mime or sniff_image_type(content, content_type)
+        if mime is None:
+            print(f"⚠️ 非图片 Content-Type: {content_type}")
+            return None
+        return hashlib.sha256(content).hexdigest(), mime, content
+
+    # 缩放并重新编码；结果没有变小时保留原图
+    def _shrink(self, content: bytes, mime: str) -> Tuple[bytes, str]:
+        started = time.perf_counter()
+        try:
+            with Image.open(io.BytesIO(content)) as img:
+                img.seek(0)  # 动图只取第一帧
+                needs_resize = max(img.size) > self._max_edge
+                if not needs_resize and len(content) <= 256 * 1024:
+                    return content, mime
+
+                frame = img.convert("RGBA") if img.mode in ("RGBA", "LA", "P") else img.convert("RGB")
+                if needs_resize:
+                    frame.thumbnail((self._max_edge, self._max_edge), Image.LANCZOS)
+                if frame.mode == "RGBA":
+                    background = Image.new("RGB", frame.size, (255, 255, 255))
+                    background.paste(frame, mask=frame.split()[-1])
+                    frame = background
+
+                out = io.BytesIO()
+                frame.save(out, format="JPEG", quality=self._quality, optimize=True)
+                encoded = out.getvalue()
+            if not needs_resize and len(encoded) >= len(content):
+                return content, mime
+            return encoded, "image/jpeg"
+        except Exception as e:
+            print(f"⚠️ 图片重新编码失败，使用原图: {e}")
+            return content, mime
+        finally:
+            self._stats["encode_seconds"] += time.perf_counter() - started
+
+    async def _load(self, url: str, key: str) -> Optional[str]:
+        try:
+            return await self._load_uncached(url, key)
+        except Exception as e:
+            print(f"⚠️ 处理异常: {e}")
+            self._stats["failures"] += 1
+            return None
+
+    async def _load_uncached(self, url: str, key: str) -> Optional[str]:
+        if self._disk_dir:
+            hit = await asyncio.to_thread(self._disk_get, key)
+            if hit is not None:
+                self._stats["disk_hits"] += 1
+                self._memory_put(key, *hit)
+                return hit[1]
+
+        self._stats["misses"] += 1
+        try:
+            result = await self._download(url)
+        except httpx.HTTPError as e:
+            print(f"⚠️ 请求失败: {e}")
+            result = None
+        if result is None:
+            self._stats["failures"] += 1
+            return None
+
+        # 内容哈希基于原图，缓存的是缩放后的版本
+        digest, mime, content = result
+        data_url = self._blobs.get(digest)
+        if data_url is None:
+            self._stats["bytes_original"] += len(content)
+            content, mime = await asyncio.to_thread(self._shrink, content, mime)
+            self._stats["bytes_encoded"] += len(content)
+            data_url = f"data:{mime};base64,{base64.b64encode(content).decode('utf-8')}"
+        else:
+            # 同一内容换了个 URL：不再编码，但新 URL 键也要落盘，重启后才能命中
+            mime, content = data_url[5:data_url.index(";")], None
+        if self._disk_dir:
+            await asyncio.to_thread(self._disk_put, key, digest, mime, content)
+        self._memory_put(key, digest, data_url)
+        return data_url
+
+    # 获取单张图片，返回 data:<mime>;base64,... 或 None（出错时）
+    async def fetch(self, url: Optional[str]) -> Optional[str]:
+        if not url:
+            return None
+        key = _url_key(url)
+
+        data_url = self._memory_get(key)
+        if data_url is not None:
+            self._stats["memory_hits"] += 1
+            return data_url
+
+        # single-flight：同一图片只有一个下载任务，调用方被取消也不影响其他等待者
+        task = self._inflight.get(key)
+        if task is not None:
+            self._stats["joined"] += 1
+        else:
+            task = asyncio.create_task(self._load(url, key))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _t, k=key: self._inflight.pop(k, None))
+        return await asyncio.shield(task)
+
+    # 并发获取多张图片，结果与 urls 顺序一致
+    async def fetch_many(self, urls: List[Optional[str]]) -> List[Optional[str]]:
+        if not urls:
+            return []
+        return list(await asyncio.gather(*(self.fetch(u) for u in urls)))
+
+    # 获取缓存统计信息（调试用）
+    def get_stats(self) -> dict:
+        hits = self._stats["memory_hits"] + self._stats["disk_hits"] + self._stats["joined"]
+        total = hits + self._stats["misses"]
+        # 只比较真正编码过的图片（不含中断的下载和重复内容）
+        original, encoded = self._stats["bytes_original"], self._stats["bytes_encoded"]
+        return {
+            **self._stats,
+            "bytes_saved": max(0, original - encoded),
+            "hit_rate": hits / total if total else 0.0,
+            "cached_images": len(self._blobs),
+            "cached_bytes": self._blob_bytes,
+        }
+
+
+IMAGE_FETCHER = ImageFetcher(
+    max_items=config.IMAGE_CACHE_ITEMS,
+    max_bytes=config.IMAGE_CACHE_MAX_MB * 1024 * 1024,
+    disk_dir=config.IMAGE_CACHE_DIR,
+    max_download_bytes=config.IMAGE_MAX_DOWNLOAD_MB * 1024 * 1024,
+    max_edge=config.IMAGE_MAX_EDGE,
+    quality=config.IMAGE_JPEG_QUALITY,
+)
@@ -1,45 +1,46 @@
 import os
 import random
+import asyncio
 import datetime
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+import threading
+import time
+from collections import OrderedDict
+import httpx
+from core.function_hedge import RaceStats, hedged_race
+from core.function_acg_pool import ACG_POOL, Reservation, pool_key
 
 # ========== Proxy & Session ==========
 PROXY_URL = os.environ.get("ACG_PROXY", "http://127.0.0.1:7890")
-DEFAULT_TIMEOUT = 12  # 统一超时
-
-def _build_session(proxy_url=PROXY_URL, timeout=DEFAULT_TIMEOUT):
-    s = requests.Session()
-    # 统一代理
-    if proxy_url:
-        s.proxies.update({
-            "http": proxy_url,
-            "https": proxy_url,
-        })
-    # 统一 UA
-    s.headers.update({"User-Agent": "acg-fetcher/1.0"})
-    # 失败重试（对网络波动更稳）
-    retry = Retry(
-        total=3,
-        backoff_factor=0.6,
-        status_forcelist=[429, 500, 502, 503, 504],
-        allowed_methods={"GET", "HEAD", "OPTIONS"},
-        raise_on_status=False,
+DEFAULT_TIMEOUT = 12  # 单次请求超时
+MAX_RETRIES = 2       # 429 / 5xx / 网络错误时的重试次数
+RACE_DEADLINE = 15    # 所有图源并发竞速的总时限
+
+def _build_async_session(proxy_url=PROXY_URL, timeout=DEFAULT_TIMEOUT):
+    # 统一代理 + 统一 UA，连接复用
+    return httpx.AsyncClient(
+        proxy=proxy_url or None,
+        timeout=timeout,
+        headers={"User-Agent": "acg-fetcher/1.0"},
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=30.0),
     )
-    adapter = HTTPAdapter(max_retries=retry)
-    s.mount("http://", adapter)
-    s.mount("https://", adapter)
 
-    # 包一层默认 timeout
-    _request = s.request
-    def _request_with_timeout(method, url, **kwargs):
-        kwargs.setdefault("timeout", timeout)
-        return _request(method, url, **kwargs)
-    s.request = _request_with_timeout
-    return s
+SESSION = _build_async_session()
 
-SESSION = _build_session()
+async def _get(url, params=None, headers=None):
+    """
+    GET + 失败重试（对网络波动更稳），退避 0.6s、1.2s...
+    返回最后一次响应；网络错误重试用尽后抛出
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            r = await SESSION.get(url, params=params, headers=headers)
+            if r.status_code not in (429, 500, 502, 503, 504) or attempt == MAX_RETRIES:
+                return r
+        except httpx.TransportError:
+            if attempt == MAX_RETRIES:
+                raise
+        await asyncio.sleep(0.6 * (2 ** attempt))
 
 # ---------- Utils ----------
 def _rand_pick(items):
@@ -52,11 +53,7 @@ def _days_ago(n):
 # Docs: https://github.com/danbooru/danbooru/blob/master/doc/api.txt
 DANBASE = "https://danbooru.donmai.us/posts.json"
 
-def fetch_danbooru_one(tags, recent_days=14, rating="e"):
-    """
-    从 Danbooru 取一张：默认限定最近 n 天、优先原图 file_url，不行就 large_file_url
-    R-18: rating='e' (explicit) / 'q' (questionable) / 's' (safe)
-    """
+async def _danbooru_candidates(tags, recent_days, rating):
     qtags = list(tags)
     if rating:
         qtags.append(f"rating:{rating}")
@@ -65,23 +62,28 @@ def fetch_danbooru_one(tags, recent_days=14, rating="e"):
         "tags": " ".join(qtags + ["order:id_desc"]),
         "limit": 100
     }
-    r = SESSION.get(DANBASE, params=params)
+    r = await _get(DANBASE, params=params)
     r.raise_for_status()
-    posts = r.json()
-    if not posts:
-        return None
-    pick = _rand_pick(posts)
-    return pick.get("file_url") or pick.get("large_file_url") or pick.get("preview_file_url")
+    posts = r.json() or []
+    return [p.get("file_url") or p.get("large_file_url") or p.get("preview_file_url") for p in posts]
+
+async def fetch_danbooru_one(tags, recent_days=14, rating="e", reserve=False):
+    """
+    从 Danbooru 取一张：默认限定最近 n 天、优先原图 file_url，不行就 large_file_url
+    R-18: rating='e' (explicit) / 'q' (questionable) / 's' (safe)
+    整页候选进 ACG_POOL，之后同标签直接从池子里抽；reserve=True 时只预留（见 ResultPool.pick）
+    """
+    return await ACG_POOL.pick(
+        pool_key("danbooru", tags, rating),
+        lambda: _danbooru_candidates(tags, recent_days, rating),
+        reserve=reserve,
+    )
 
 # ---------- yande.re (Moebooru) ----------
 # Docs: https://yande.re/help/api , v2: https://yande.re/post.json?api_version=2
 YANBASE = "https://yande.re/post.json"
 
-def fetch_yandere_one(tags, recent_days=14, rating="e"):
-    """
-    yande.re v2 JSON，按最新抓一批再随机
-    rating: 's'/'q'/'e'；Moebooru风格
-    """
+async def _yandere_candidates(tags, rating):
     qtags = list(tags)
     if rating:
         qtags.append(f"rating:{rating}")
@@ -91,24 +93,30 @@ def fetch_yandere_one(tags, recent_days=14, rating="e"):
         "limit": 100,         # 拿一批
         "page": 1             # id_desc 默认最新
     }
-    r = SESSION.get(YANBASE, params=params)
+    r = await _get(YANBASE, params=params)
     r.raise_for_status()
-    posts = r.json()
-    if not posts:
-        return None
-    pick = _rand_pick(posts)
+    data = r.json() or []
+    # v2 返回 {"posts": [...]}；旧版直接是列表
+    posts = data.get("posts", []) if isinstance(data, dict) else data
     # v2 字段可能是 'file_url' / 'jpeg_url' / 'sample_url'
-    return pick.get("file_url") or pick.get("jpeg_url") or pick.get("sample_url")
+    return [p.get("file_url") or p.get("jpeg_url") or p.get("sample_url") for p in posts]
+
+async def fetch_yandere_one(tags, recent_days=14, rating="e", reserve=False):
+    """
+    yande.re v2 JSON，按最新抓一批再随机
+    rating: 's'/'q'/'e'；Moebooru风格
+    """
+    return await ACG_POOL.pick(
+        pool_key("yandere", tags, rating),
+        lambda: _yandere_candidates(tags, rating),
+        reserve=reserve,
+    )
 
 # ---------- Gelbooru (HTTP 直调) ----------
 # Many clients exist; here use simple REST to avoid extra deps.
 GELBASE = "https://gelbooru.com/index.php"
 
-def fetch_gelbooru_one(tags, recent_days=14, rating="explicit"):
-    """
-    Gelbooru JSON API，取最新一批后随机
-    rating 可用: 'safe'/'questionable'/'explicit'
-    """
+async def _gelbooru_candidates(tags, rating):
     qtags = list(tags)
     if rating:
         qtags.append(f"rating:{rating}")
@@ -120,22 +128,33 @@ def fetch_gelbooru_one(tags, recent_days=14, rating="explicit"):
         "limit": 100,
         "tags": " ".join(qtags) + " sort:date:desc"
     }
-    r = SESSION.get(GELBASE, params=params, headers={"User-Agent": "qq-bot/1.0"})
+    r = await _get(GELBASE, params=params, headers={"User-Agent": "qq-bot/1.0"})
     # ↑ 已有全局 UA，这里保留原实现；也可省略此 headers
     if r.headers.get("Content-Type", "").startswith("application/json"):
-        posts = r.json()
+        posts = r.json() or []
     else:
         posts = []
-    if not posts:
-        return None
-    pick = _rand_pick(posts)
-    return pick.get("file_url") or pick.get("source") or pick.get("preview_url")
+    # 新版 API 返回 {"@attributes": ..., "post": [...]}
+    if isinstance(posts, dict):
+        posts = posts.get("post", [])
+    return [p.get("file_url") or p.get("source") or p.get("preview_url") for p in posts]
+
+async def fetch_gelbooru_one(tags, recent_days=14, rating="explicit", reserve=False):
+    """
+    Gelbooru JSON API，取最新一批后随机
+    rating 可用: 'safe'/'questionable'/'explicit'
+    """
+    return await ACG_POOL.pick(
+        pool_key("gelbooru", tags, rating),
+        lambda: _gelbooru_candidates(tags, rating),
+        reserve=reserve,
+    )
 
 # ---------- Lolicon API ----------
 # Docs: https://docs.api.lolicon.app/
 LOLI = "https://api.lolicon.app/setu/v2"
 
-def fetch_lolicon_one(tags, r18=True, exclude_ai=False):
+async def fetch_lolicon_one(tags, r18=True, exclude_ai=False):
     """
     Lolicon 官方 API，返回原图 urls.original
     r18: True 使用 r18=1
@@ -148,7 +167,7 @@ def fetch_lolicon_one(tags, r18=True, exclude_ai=False):
         params["tag"] = tags  # 支持列表
     if exclude_ai:
         params["excludeAI"] = True
-    r = SESSION.get(LOLI, params=params)
+    r = await _get(LOLI, params=params)
     r.raise_for_status()
     data = r.json().get("data", [])
     if not data:
@@ -159,6 +178,10 @@ def fetch_lolicon_one(tags, r18=True, exclude_ai=False):
 
 # ---------- Pixiv (App-API via pixivpy) ----------
 # pip install pixivpy
+PIXIV_REFRESH_MARGIN = 300  # access token 过期前多少秒后台刷新
+PIXIV_PAGE_TTL = 600        # search_illust 结果页缓存时长
+PIXIV_MAX_PAGES = 64
+
 def _build_pixiv_appapi_client():
     try:
         from pixivpy3 import AppPixivAPI
@@ -168,24 +191,130 @@ def _build_pixiv_appapi_client():
     if not refresh_token:
         return None, "PIXIV_REFRESH_TOKEN missing"
     api = AppPixivAPI(proxies={"http": PROXY_URL, "https": PROXY_URL} if PROXY_URL else None, timeout=DEFAULT_TIMEOUT)
-    api.auth(refresh_token=refresh_token)
     return api, None
 
+class PixivClient:
+    """
+    进程内共用一个 AppPixivAPI（复用连接）：
+    - 只在第一次使用时完整 auth，之后在 access token 过期前由后台定时线程刷新
+    - search_illust 的结果页按 (word, target, sort) 缓存 PIXIV_PAGE_TTL 秒
+    调用方在工作线程中使用（pixivpy 是同步库）
+    """
+
+    def __init__(self, refresh_margin=PIXIV_REFRESH_MARGIN, page_ttl=PIXIV_PAGE_TTL, max_pages=PIXIV_MAX_PAGES):
+        self._refresh_margin = refresh_margin
+        self._page_ttl = page_ttl
+        self._max_pages = max_pages
+        self._api = None
+        # _lock 只保护页缓存与统计（不做网络请求）；auth 的网络往返由 _auth_lock 串行
+        self._lock = threading.Lock()
+        self._auth_lock = threading.Lock()
+        self._timer = None
+        self._pages = OrderedDict()
+        self._stats = {"auths": 0, "auth_failures": 0, "page_hits": 0, "page_misses": 0}
+
+    def _count(self, field):
+        with self._lock:
+            self._stats[field] += 1
+
+    def _auth(self):
+        # 调用方持有 self._auth_lock
+        refresh_token = getattr(self._api, "refresh_token", None) or os.environ.get("PIXIV_REFRESH_TOKEN")
+        try:
+            resp = self._api.auth(refresh_token=refresh_token)
+            self._count("auths")
+        except Exception:
+            self._count("auth_failures")
+            self._schedule_refresh(60)
+            raise
+        expires_in = (resp or {}).get("expires_in", 3600) if isinstance(resp, dict) else 3600
+        self._schedule_refresh(max(60, expires_in - self._refresh_margin))
+
+    def _schedule_refresh(self, delay):
+        if self._timer:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self._refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refresh(self):
+        with self._auth_lock:
+            if self._api is None:
+                return
+            try:
+                self._auth()
+            except Exception as e:
+                print(f"⚠️ Pixiv token 刷新失败: {e}")
+
+    def get_api(self):
+        with self._auth_lock:
+            if self._api is None:
+                api, err = _build_pixiv_appapi_client()
+                if not api:
+                    raise RuntimeError(f"Pixiv App-API unavailable: {err}")
+                self._api = api
+                try:
+                    self._auth()
+                except Exception:
+                    self._api = None
+                    raise
+            return self._api
+
+    # 只有 token 无效 / 过期才值得重新 auth（限流、标签错误等重试也没用）
+    @staticmethod
+    def _is_token_error(error):
+        message = str(error.get("message", "") if isinstance(error, dict) else error).lower()
+        return "oauth" in message or "access token" in message or "invalid_grant" in message
+
+    def search_illust(self, word, search_target="partial_match_for_tags", sort="date_desc"):
+        key = (word, search_target, sort)
+        with self._lock:
+            hit = self._pages.get(key)
+            if hit and time.time() - hit[0] <= self._page_ttl:
+                self._pages.move_to_end(key)
+                self._stats["page_hits"] += 1
+                return hit[1]
+            self._stats["page_misses"] += 1
+
+        api = self.get_api()
+        json_result = api.search_illust(word, search_target=search_target, sort=sort)
+        # token 在刷新前失效（如休眠后）：重新 auth 一次再查
+        if json_result and json_result.get("error") and self._is_token_error(json_result.get("error")):
+            with self._auth_lock:
+                self._auth()
+            json_result = api.search_illust(word, search_target=search_target, sort=sort)
+        if json_result and json_result.get("error"):
+            raise RuntimeError(f"Pixiv search failed: {json_result.get('error')}")
+        illusts = (json_result.illusts or []) if json_result else []
+
+        with self._lock:
+            self._pages[key] = (time.time(), illusts)
+            self._pages.move_to_end(key)
+            while len(self._pages) > self._max_pages:
+                self._pages.popitem(last=False)
+        return illusts
+
+    def close(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    # 获取 Pixiv 客户端统计信息（调试用）
+    def get_stats(self):
+        return {**self._stats, "authed": self._api is not None, "cached_pages": len(self._pages)}
+
+PIXIV = PixivClient()
+
 def fetch_pixiv_one(tags, recent_days=14, r18=True, exclude_ai=False):
     """
     Pixiv App-API 搜索：按时间倒序抓一批再随机；返回原图 url
     """
-    api, err = _build_pixiv_appapi_client()
-    if not api:
-        raise RuntimeError(f"Pixiv App-API unavailable: {err}")
-
     # 搜索词：Pixiv 支持空格分隔 OR/AND，简单起见直接空格 join
     word = " ".join(tags) if tags else ""
     search_target = "partial_match_for_tags"   # 更宽松的标签匹配
     sort = "date_desc"
     # R-18：App-API 用 "search_illust" + word中可含 r-18 标签；后续再二次过滤 x_restrict
-    json_result = api.search_illust(word, search_target=search_target, sort=sort)
-    illusts = (json_result.illusts or []) if json_result else []
+    illusts = PIXIV.search_illust(word, search_target=search_target, sort=sort)
     if not illusts:
         return None
 
@@ -231,29 +360,53 @@ def fetch_pixiv_one(tags, recent_days=14, r18=True, exclude_ai=False):
     return url
 
 # ---------- Unified entry ----------
-def fetch_acg_one(tags, prefer=("pixiv","danbooru","yandere","gelbooru","lolicon"), r18=True):
+# 各图源的耗时与成败统计
+ACG_PROVIDER_STATS = RaceStats()
+
+def _provider_call(src, tags, r18):
     dan_rating = "e" if r18 else "s"
     yan_rating = "e" if r18 else "s"
     gel_rating = "explicit" if r18 else "safe"
 
-    for src in prefer:
+    # booru 图源只预留候选，竞速胜出后才从池子里取出
+    if src == "danbooru":
+        return fetch_danbooru_one(tags, rating=dan_rating, reserve=True)
+    if src == "yandere":
+        return fetch_yandere_one(tags, rating=yan_rating, reserve=True)
+    if src == "gelbooru":
+        return fetch_gelbooru_one(tags, rating=gel_rating, reserve=True)
+    if src == "pixiv":
+        # pixivpy 是同步库，放到线程里跑
+        return asyncio.to_thread(fetch_pixiv_one, tags, r18=r18)
+    if src == "lolicon":
+        return fetch_lolicon_one(tags, r18=r18)
+    return None
+
+async def fetch_acg_one(tags, prefer=("pixiv","danbooru","yandere","gelbooru","lolicon"), r18=True,
+                        deadline=RACE_DEADLINE):
+    """
+    所有图源并发请求，返回总时限内第一个拿到的 (url, src)，其余请求取消
+    同时返回的按 prefer 顺序取靠前者；全部失败 / 超时返回 (None, None)
+    """
+    sources = [src for src in prefer if src in ("pixiv", "danbooru", "yandere", "gelbooru", "lolicon")]
+
+    async def _run(src):
+        print(f"尝试从 {src} 取图...")
         try:
-            print(f"尝试从 {src} 取图...")
-            if src == "danbooru":
-                url = fetch_danbooru_one(tags, rating=dan_rating)
-            elif src == "yandere":
-                url = fetch_yandere_one(tags, rating=yan_rating)
-            elif src == "gelbooru":
-                url = fetch_gelbooru_one(tags, rating=gel_rating)
-            elif src == "pixiv":
-                url = fetch_pixiv_one(tags, r18=r18)   # <- 新增
-            elif src == "lolicon":
-                url = fetch_lolicon_one(tags, r18=r18)
-            else:
-                continue
-            if url:
-                return url, src
+            return await _provider_call(src, tags, r18)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             print(f"⚠️ 从 {src} 取图失败: {e}")
-            continue
-    return None, None
\ No newline at end of file
+            raise
+
+    try:
+        src, url = await hedged_race(sources, _run, delay=0, deadline=deadline, stats=ACG_PROVIDER_STATS)
+        if isinstance(url, Reservation):
+            url = ACG_POOL.commit(url)
+        return url, src
+    except asyncio.TimeoutError:
+        print(f"⚠️ 取图超过 {deadline}s，放弃")
+    except Exception:
+        pass
+    return None, None
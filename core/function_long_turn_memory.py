@@ -1,10 +1,103 @@
 import re
-from typing import Dict, Optional
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Dict, Hashable, Optional
 from mem0 import Memory
 import config
+from core.function_stats import percentile
 
 # 初始化 Mem0 客户端
-MEMORY = Memory.from_config(config.MEM0_CONFIG)
+def _build_memory():
+    """
+    LONG_MEMORY_BACKEND:
+    - "milvus"：使用 MEM0_CONFIG 中的远程向量库
+    - "faiss" ：向量存本地（LocalFaissStore），mem0 的其它部分（抽取记忆的 LLM、embedding）不变
+    """
+    if config.LONG_MEMORY_BACKEND != "faiss":
+        return Memory.from_config(config.MEM0_CONFIG)
+
+    from core.function_faiss_store import LocalFaissStore
+
+    remote = config.MEM0_CONFIG["vector_store"]["config"]
+    # 不连远程向量库：先用 mem0 默认的本地库初始化，再换成 FAISS
+    memory = Memory.from_config({k: v for k, v in config.MEM0_CONFIG.items() if k != "vector_store"})
+    memory.vector_store = LocalFaissStore(
+        path=config.FAISS_DIR,
+        collection_name=remote["collection_name"],
+        embedding_model_dims=remote["embedding_model_dims"],
+    )
+    return memory
+
+
+MEMORY = _build_memory()
+
+
+# 带 TTL 的 LRU 缓存（线程安全：embedding 在工作线程里调用）
+class TTLCache:
+    def __init__(self, max_items: int = 512, ttl: float = 300.0):
+        self._max_items = max_items
+        self._ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or time.monotonic() - item[0] > self._ttl:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self._max_items:
+                self._data.popitem(last=False)
+
+    # 删除满足条件的键
+    def discard_where(self, predicate) -> int:
+        with self._lock:
+            keys = [k for k in self._data if predicate(k)]
+            for k in keys:
+                del self._data[k]
+            return len(keys)
+
+    def get_stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"items": len(self._data), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+# 给 mem0 的 embedding 模型套一层查询向量缓存（同一句话不重复请求 embedding 接口）
+class CachedEmbedder:
+    def __init__(self, inner, cache: TTLCache):
+        self._inner = inner
+        self._cache = cache
+
+    def embed(self, text, *args, **kwargs):
+        key = (text, args, tuple(sorted(kwargs.items())))
+        vector = self._cache.get(key)
+        if vector is None:
+            vector = self._inner.embed(text, *args, **kwargs)
+            self._cache.put(key, vector)
+        return vector
+
+    def __getattr__(self, name):
+        return getattr(self._inner, name)
+
+
+EMBEDDING_CACHE = TTLCache(max_items=config.EMBEDDING_CACHE_ITEMS, ttl=config.EMBEDDING_CACHE_TTL)
+if hasattr(MEMORY, "embedding_model"):
+    MEMORY.embedding_model = CachedEmbedder(MEMORY.embedding_model, EMBEDDING_CACHE)
 
 class LocalDictStore:
     """
@@ -15,6 +108,11 @@ class LocalDictStore:
 
     def __init__(self, *args, **kwargs):
         self.m = MEMORY
+        # 每个用户的检索结果缓存；add_turn 写入新记忆后作废该用户的条目
+        self._results = TTLCache(max_items=config.LONG_MEMORY_CACHE_ITEMS, ttl=config.LONG_MEMORY_CACHE_TTL)
+        # 写入代数：检索期间有新写入时，结果不进缓存
+        self._generation: Dict[str, int] = {}
+        self._latency = deque(maxlen=256)
 
     def get(self, user_id: str, query: Optional[str] = None, limit: int = 3) -> Dict[str, str]:
         """
@@ -35,6 +133,37 @@ class LocalDictStore:
                 dic[f"mem_{i}"] = text
         return dic
 
+    # 异步检索（带缓存），不阻塞事件循环
+    async def aget(self, user_id: str, query: Optional[str] = None, limit: int = 3) -> Dict[str, str]:
+        user_id = str(user_id)
+        key = (user_id, query, limit)
+        cached = self._results.get(key)
+        if cached is not None:
+            return dict(cached)
+
+        generation = self._generation.get(user_id, 0)
+        started = time.perf_counter()
+        dic = await asyncio.to_thread(self.get, user_id, query, limit)
+        self._latency.append(time.perf_counter() - started)
+        if self._generation.get(user_id, 0) == generation:
+            self._results.put(key, dic)
+        return dict(dic)
+
+    # 作废某个用户的检索缓存
+    def invalidate(self, user_id: str) -> None:
+        user_id = str(user_id)
+        self._generation[user_id] = self._generation.get(user_id, 0) + 1
+        self._results.discard_where(lambda k: k[0] == user_id)
+
+    # 获取检索统计信息（调试用）
+    def get_stats(self) -> dict:
+        return {
+            "results": self._results.get_stats(),
+            "embeddings": EMBEDDING_CACHE.get_stats(),
+            "retrieval_p50": percentile(self._latency, 0.50),
+            "retrieval_p95": percentile(self._latency, 0.95),
+        }
+
     # mem0 自动抽记忆
     def add_turn(self, user_id: str, user_text: str, assistant_text: str):
         user_id = str(user_id)
@@ -43,7 +172,10 @@ class LocalDictStore:
             {"role": "user", "content": user_text},
             {"role": "assistant", "content": assistant_text},
         ]
-        self.m.add(messages, user_id=user_id)
+        try:
+            self.m.add(messages, user_id=user_id)
+        finally:
+            self.invalidate(user_id)
 
 
 # 将字典转化为序列
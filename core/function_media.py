@@ -0,0 +1,177 @@
+import asyncio
+import base64
+import copy
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import config
+
+
+# 本地图片路径（file://... 或存在的路径）；不是本地文件时返回 None
+def _local_path(file: str) -> Optional[str]:
+    path = file[7:] if file.startswith("file://") else file
+    return path if os.path.isfile(path) else None
+
+
+# 媒体文件引用注册表
+class MediaRegistry:
+    """
+    同一张网络图片（如 /s img 的 ACG 图片 URL）再次发送时，让 NapCat 复用已缓存的文件：
+    - 发送成功后通过 get_msg 取回 OneBot 记录的图片 file，按 URL 记下来
+    - 之后再发同一 URL 时直接用这个 file，省掉 NapCat 重新下载
+    - 用缓存引用发送失败时作废该条目，由调用方按原内容重发
+    - 只登记 http(s) URL：表情包本来就是 NapCat 缓存文件名，运势卡片每次都是新图，登记了也不会命中
+    - 本地文件默认转成 base64://（NapCat 与机器人不在同一台机器时也能用）；
+      local_files=True 时发 file:// 路径
+    - 条目数有上限（按最近使用淘汰），有效期 ttl 秒，持久化到 JSON
+    """
+
+    def __init__(self, path: Optional[str] = None, max_entries: int = 1000, ttl: float = 3 * 86400,
+                 local_files: bool = False, save_interval: float = 60.0):
+        self._path = path
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._local_files = local_files
+        self._save_interval = save_interval
+        self._last_save = 0.0
+        self._dirty = False
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._stats = {"media_messages": 0, "hits": 0, "misses": 0, "learned": 0, "invalidated": 0}
+        self.load()
+
+    def _lookup(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry["learned_at"] > self._ttl:
+            del self._entries[key]
+            self._dirty = True
+            return None
+        entry["uses"] += 1
+        self._entries.move_to_end(key)
+        return entry["file"]
+
+    def _resolve_local(self, path: str) -> str:
+        if self._local_files:
+            return "file://" + os.path.abspath(path)
+        with open(path, "rb") as f:
+            return "base64://" + base64.b64encode(f.read()).decode("ascii")
+
+    # 替换图片段为已缓存的引用；返回 (发送用 params, 待学习的 (段序号, 资源键), 已替换的资源键)
+    async def prepare(self, params: dict):
+        message = params.get("message")
+        if not isinstance(message, list):
+            return params, [], []
+
+        params = copy.deepcopy(params)
+        pending: List[Tuple[int, str]] = []
+        substituted: List[str] = []
+        for idx, seg in enumerate(params["message"]):
+            data = seg.get("data") or {}
+            file = data.get("file")
+            if seg.get("type") != "image" or not isinstance(file, str):
+                continue
+
+            if file.startswith(("http://", "https://")):
+                key = "url:" + file
+                cached = self._lookup(key)
+                if cached:
+                    data["file"] = cached
+                    substituted.append(key)
+                    self._stats["hits"] += 1
+                else:
+                    pending.append((idx, key))
+                    self._stats["misses"] += 1
+                continue
+
+            # 本地文件只做格式转换，读文件放到线程里
+            local_path = _local_path(file)
+            if local_path:
+                data["file"] = await asyncio.to_thread(self._resolve_local, local_path)
+
+        if pending or substituted:
+            self._stats["media_messages"] += 1
+        return params, pending, substituted
+
+    # 从已发出的消息里学习 OneBot 记录的图片 file
+    async def learn(self, client, resp: dict, pending: List[Tuple[int, str]]) -> None:
+        message_id = (resp.get("data") or {}).get("message_id")
+        if not pending or message_id is None:
+            return
+        try:
+            msg = await client.call("get_msg", {"message_id": message_id})
+        except Exception as e:
+            print(f"⚠️ 获取已发送图片信息失败: {e}")
+            return
+
+        segments = (msg.get("data") or {}).get("message") or []
+        images = [seg.get("data") or {} for seg in segments if isinstance(seg, dict) and seg.get("type") == "image"]
+        # 发出的消息只按图片顺序对应（文本段可能被合并）
+        for (_, key), data in zip(pending, images):
+            file = data.get("file")
+            if not file or file.startswith(("base64://", "file://")):
+                continue
+            self._entries[key] = {"file": file, "learned_at": time.time(), "uses": 0}
+            self._entries.move_to_end(key)
+            self._stats["learned"] += 1
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+        self._dirty = True
+        self._maybe_save()
+
+    def invalidate(self, keys: List[str]) -> None:
+        for key in keys:
+            if self._entries.pop(key, None) is not None:
+                self._stats["invalidated"] += 1
+                self._dirty = True
+
+    def _maybe_save(self) -> None:
+        if self._path and time.time() - self._last_save >= self._save_interval:
+            self.save()
+
+    def save(self) -> None:
+        if not self._path or not self._dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+            tmp = self._path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(tmp, self._path)
+            self._last_save = time.time()
+            self._dirty = False
+        except Exception as e:
+            print(f"⚠️ 保存媒体引用失败: {e}")
+
+    def load(self) -> None:
+        if not self._path or not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path, "r", encoding="utf-8") as f:
+                data: Dict[str, dict] = json.load(f)
+            now = time.time()
+            items = [(k, v) for k, v in data.items() if now - v.get("learned_at", 0) <= self._ttl]
+            for key, entry in items[-self._max_entries:]:
+                self._entries[key] = entry
+            print(f"📂 已加载 {len(self._entries)} 条媒体引用")
+        except Exception as e:
+            print(f"⚠️ 读取媒体引用失败: {e}")
+
+    # 获取媒体引用统计信息（调试用）
+    def get_stats(self) -> dict:
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            **self._stats,
+            "entries": len(self._entries),
+            "hit_rate": self._stats["hits"] / lookups if lookups else 0.0,
+        }
+
+
+MEDIA = MediaRegistry(
+    path=config.MEDIA_REGISTRY_PATH,
+    ttl=config.MEDIA_REGISTRY_TTL,
+    local_files=config.MEDIA_LOCAL_FILES,
+)
@@ -0,0 +1,244 @@
+import asyncio
+import json
+import os
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+import httpx
+import config
+
+
+# 熔断状态
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+@dataclass
+# 单个模型的健康状态
+class ModelHealth:
+    ewma_latency: Optional[float] = None
+    error_rate: float = 0.0
+    successes: int = 0
+    failures: int = 0
+    timeouts: int = 0
+    consecutive_failures: int = 0
+    state: str = CLOSED
+    opened_at: float = 0.0
+    probing: bool = field(default=False, repr=False)
+
+
+# 判断异常是否属于超时
+def is_timeout_error(e: BaseException) -> bool:
+    if isinstance(e, (asyncio.TimeoutError, httpx.TimeoutException)):
+        return True
+    return "timeout" in type(e).__name__.lower()
+
+
+# 模型健康注册表
+class ModelHealthRegistry:
+    """
+    - 每次补全 / 判定调用后记录：EWMA 耗时、EWMA 错误率、超时次数
+    - 连续失败或错误率过高时打开熔断；冷却 open_seconds 后进入半开，放行一次探测
+    - order() 在配置顺序基础上降级不健康的模型，熔断中的模型被跳过
+    - 状态持久化到 JSON，重启后保留
+    """
+
+    def __init__(
+            self,
+            path: Optional[str] = None,
+            alpha: float = 0.2,
+            failure_threshold: int = 3,
+            error_rate_threshold: float = 0.5,
+            min_calls: int = 5,
+            open_seconds: float = 60.0,
+            save_interval: float = 30.0,
+            degrade_error_rate: float = 0.3,
+            degrade_latency_factor: float = 2.0,
+    ):
+        self._path = path
+        self._alpha = alpha
+        self._failure_threshold = failure_threshold
+        self._error_rate_threshold = error_rate_threshold
+        self._min_calls = min_calls
+        self._open_seconds = open_seconds
+        self._save_interval = save_interval
+        self._degrade_error_rate = degrade_error_rate
+        self._degrade_latency_factor = degrade_latency_factor
+        self._last_save = 0.0
+        self._models: Dict[str, ModelHealth] = {}
+        self.load()
+
+    def _get(self, name: str) -> ModelHealth:
+        h = self._models.get(name)
+        if h is None:
+            h = ModelHealth()
+            self._models[name] = h
+        return h
+
+    # 冷却期结束的熔断转为半开
+    def _refresh_state(self, h: ModelHealth) -> None:
+        if h.state == OPEN and time.time() - h.opened_at >= self._open_seconds:
+            h.state = HALF_OPEN
+            h.probing = False
+
+    def _open(self, name: str, h: ModelHealth) -> None:
+        h.state = OPEN
+        h.opened_at = time.time()
+        h.probing = False
+        print(f"🔌 模型 {name} 熔断打开（错误率 {h.error_rate:.2f}，连续失败 {h.consecutive_failures}）")
+
+    # 是否允许调用；半开状态只放行一个探测请求
+    def acquire(self, name: str) -> bool:
+        h = self._get(name)
+        self._refresh_state(h)
+        if h.state == CLOSED:
+            return True
+        if h.state == HALF_OPEN and not h.probing:
+            h.probing = True
+            return True
+        return False
+
+    def record_success(self, name: str, latency: float) -> None:
+        h = self._get(name)
+        a = self._alpha
+        h.ewma_latency = latency if h.ewma_latency is None else a * latency + (1 - a) * h.ewma_latency
+        h.error_rate = (1 - a) * h.error_rate
+        h.successes += 1
+        h.consecutive_failures = 0
+        if h.state != CLOSED:
+            print(f"✅ 模型 {name} 探测成功，熔断关闭")
+            h.state = CLOSED
+            h.probing = False
+        self._maybe_save()
+
+    def record_failure(self, name: str, timeout: bool = False) -> None:
+        h = self._get(name)
+        a = self._alpha
+        h.error_rate = a + (1 - a) * h.error_rate
+        h.failures += 1
+        h.consecutive_failures += 1
+        if timeout:
+            h.timeouts += 1
+
+        if h.state == HALF_OPEN:
+            self._open(name, h)
+        elif h.state == CLOSED and (
+                h.consecutive_failures >= self._failure_threshold
+                or (h.successes + h.failures >= self._min_calls and h.error_rate >= self._error_rate_threshold)
+        ):
+            self._open(name, h)
+        self._maybe_save()
+
+    # 调用被取消（对冲落败）：不计成败，只释放探测名额
+    def record_cancelled(self, name: str) -> None:
+        h = self._get(name)
+        h.probing = False
+
+    # 样本足够且明显变差（错误率高或比最快的模型慢太多）的模型降级排到后面
+    def _degraded(self, h: ModelHealth, best_latency: Optional[float]) -> bool:
+        if h.successes + h.failures < self._min_calls:
+            return False
+        if h.error_rate >= self._degrade_error_rate:
+            return True
+        return (
+            h.ewma_latency is not None and best_latency is not None
+            and h.ewma_latency > best_latency * self._degrade_latency_factor
+        )
+
+    # 全部熔断时，把冷却最快结束的模型强制转为半开，放行一次探测
+    def _force_probe(self, names: List[str]) -> Optional[str]:
+        candidates = [(self._get(n).opened_at, idx, n) for idx, n in enumerate(names)
+                      if self._get(n).state == OPEN]
+        if not candidates:
+            return None
+        _, _, name = min(candidates)
+        h = self._get(name)
+        h.state = HALF_OPEN
+        h.probing = False
+        print(f"🔌 所有模型均熔断，提前探测 {name}")
+        return name
+
+    # 按健康度重排候选模型
+    def order(self, names: List[str]) -> List[str]:
+        """
+        - 半开（待探测）的模型排在最前，尽快验证是否恢复（有对冲兜底）
+        - 其余未熔断的模型保持配置顺序；错误率过高或明显偏慢的降级到后面（组内仍按配置顺序）
+        - 全部熔断时强制放行一个探测（冷却最先结束的那个），保证至少有模型可试
+        """
+        probes, healthy, degraded = [], [], []
+        for name in names:
+            self._refresh_state(self._get(name))
+
+        sampled = [self._get(n).ewma_latency for n in names
+                   if self._get(n).state == CLOSED and self._get(n).ewma_latency is not None]
+        best_latency = min(sampled) if sampled else None
+
+        for name in names:
+            h = self._get(name)
+            if h.state == HALF_OPEN and not h.probing:
+                probes.append(name)
+            elif h.state == CLOSED:
+                (degraded if self._degraded(h, best_latency) else healthy).append(name)
+
+        ordered = probes + healthy + degraded
+        if ordered:
+            return ordered
+
+        forced = self._force_probe(names)
+        if forced is None:
+            return list(names)
+        return [forced] + [n for n in names if n != forced]
+
+    def _maybe_save(self) -> None:
+        if self._path and time.time() - self._last_save >= self._save_interval:
+            self.save()
+
+    def save(self) -> None:
+        if not self._path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+            data = {}
+            for name, h in self._models.items():
+                item = asdict(h)
+                item.pop("probing", None)
+                data[name] = item
+            tmp = self._path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp, self._path)
+            self._last_save = time.time()
+        except Exception as e:
+            print(f"⚠️ 保存模型健康状态失败: {e}")
+
+    def load(self) -> None:
+        if not self._path or not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            for name, item in data.items():
+                self._models[name] = ModelHealth(**item)
+            print(f"📂 已加载 {len(self._models)} 个模型的健康状态")
+        except Exception as e:
+            print(f"⚠️ 读取模型健康状态失败: {e}")
+
+    # 获取健康统计信息（调试用）
+    def get_stats(self) -> dict:
+        stats = {}
+        for name, h in self._models.items():
+            self._refresh_state(h)
+            stats[name] = {
+                "state": h.state,
+                "ewma_latency": h.ewma_latency,
+                "error_rate": round(h.error_rate, 3),
+                "successes": h.successes,
+                "failures": h.failures,
+                "timeouts": h.timeouts,
+            }
+        return stats
+
+
+MODEL_HEALTH = ModelHealthRegistry(path=config.MODEL_HEALTH_PATH)
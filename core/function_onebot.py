@@ -0,0 +1,118 @@
+import asyncio
+import itertools
+import json
+from typing import Any, AsyncIterator, Dict, Optional
+
+
+# 连接关闭哨兵
+_CLOSED = object()
+
+
+# OneBot 动作客户端
+class OneBotClient:
+    """
+    单连接上的 OneBot 动作 RPC：
+    - 每个动作请求带唯一 echo，响应按 echo 回填到对应 future
+    - 只有一个读取任务消费 websocket；事件放进队列，由 events() 交给主循环
+    - 因此历史拉取、消息发送等动作可以在同一连接上并发进行
+    """
+
+    def __init__(self, ws, default_timeout: float = 10.0):
+        self._ws = ws
+        self._default_timeout = default_timeout
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._events: asyncio.Queue = asyncio.Queue()
+        self._seq = itertools.count(1)
+        self._reader: Optional[asyncio.Task] = None
+        self._closed = False
+        self._close_error: Optional[BaseException] = None
+        self._calls = 0
+        self._timeouts = 0
+        self._orphans = 0
+
+    # 启动唯一的读取任务
+    def start(self) -> None:
+        if self._reader is None:
+            self._reader = asyncio.create_task(self._read_loop())
+
+    async def _read_loop(self) -> None:
+        try:
+            async for raw in self._ws:
+                try:
+                    data = json.loads(raw)
+                except json.JSONDecodeError:
+                    print("⚠️ 收到非JSON格式消息")
+                    continue
+
+                # 带 echo 的是动作响应，不是事件
+                if isinstance(data, dict) and data.get("echo") is not None:
+                    fut = self._pending.pop(str(data.get("echo")), None)
+                    if fut is not None and not fut.done():
+                        fut.set_result(data)
+                    else:
+                        # 已超时或不是本客户端发出的请求
+                        self._orphans += 1
+                    continue
+
+                self._events.put_nowait(data)
+        except Exception as e:
+            self._close_error = e
+        finally:
+            self._closed = True
+            err = self._close_error or ConnectionError("OneBot 连接已关闭")
+            for fut in self._pending.values():
+                if not fut.done():
+                    fut.set_exception(err)
+            self._pending.clear()
+            self._events.put_nowait(_CLOSED)
+
+    # 事件流（连接异常断开时抛出原异常，便于外层重连）
+    async def events(self) -> AsyncIterator[Dict[str, Any]]:
+        self.start()
+        while True:
+            item = await self._events.get()
+            if item is _CLOSED:
+                if self._close_error is not None:
+                    raise self._close_error
+                return
+            yield item
+
+    # 调用动作并等待响应
+    async def call(self, action: str, params: Optional[dict] = None, timeout: Optional[float] = None) -> Dict[str, Any]:
+        if self._closed:
+            raise self._close_error or ConnectionError("OneBot 连接已关闭")
+        self.start()
+
+        echo = f"qqbot-{next(self._seq)}"
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[echo] = fut
+        self._calls += 1
+        try:
+            await self._ws.send(json.dumps({
+                "action": action,
+                "params": params or {},
+                "echo": echo,
+            }))
+            return await asyncio.wait_for(fut, timeout or self._default_timeout)
+        except asyncio.TimeoutError:
+            self._timeouts += 1
+            raise
+        finally:
+            self._pending.pop(echo, None)
+
+    # 关闭读取任务
+    async def close(self) -> None:
+        if self._reader is not None and not self._reader.done():
+            self._reader.cancel()
+            await asyncio.gather(self._reader, return_exceptions=True)
+
+    # 获取调用统计信息（调试用）
+    def get_stats(self) -> dict:
+        return {
+            "calls": self._calls,
+            "in_flight": len(self._pending),
+            "timeouts": self._timeouts,
+            "orphan_responses": self._orphans,
+            "queued_events": self._events.qsize(),
+            "closed": self._closed,
+        }
@@ -0,0 +1,220 @@
+import asyncio
+import heapq
+import itertools
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+import config
+from core.function_media import MEDIA
+
+
+# 发送优先级（数值越小越先发）
+PRIORITY_REPLY = 0
+PRIORITY_COMMAND = 1
+PRIORITY_EMOJI = 2
+PRIORITY_PUSH = 3
+
+
+# 令牌桶
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    # 距离拿到一个令牌还需等待的秒数
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self._rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self._tokens -= 1
+
+
+@dataclass(order=True)
+# 待发送的消息
+class _Outgoing:
+    priority: int
+    seq: int
+    target: str = field(compare=False)
+    params: dict = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    timeout: Optional[float] = field(compare=False, default=None)
+    enqueued_at: float = field(compare=False, default_factory=time.monotonic)
+
+
+# 计算发送目标
+def _target_of(params: dict) -> str:
+    if params.get("message_type") == "group" or "group_id" in params:
+        return f"group:{params.get('group_id')}"
+    return f"user:{params.get('user_id')}"
+
+
+# 出站发送调度器
+class OutboundScheduler:
+    """
+    所有 send_msg 统一经由这里发出：
+    - 全局令牌桶限制整条 OneBot 连接的发送速率
+    - 每个群 / 用户各有一个令牌桶，避免短时间内对同一目标刷屏触发风控
+    - 按优先级发送：直接回复 > 命令结果 > 表情 > 定时推送；同优先级先到先发
+    - 队列满时 send_msg 等待（背压），只有调度任务在等待令牌，调用方不会 sleep 占着循环
+    """
+
+    def __init__(
+            self,
+            global_rate: float = 2.0,
+            global_burst: float = 5,
+            target_rate: float = 0.5,
+            target_burst: float = 3,
+            max_queue: int = 200,
+            media=None,
+    ):
+        self._global = TokenBucket(global_rate, global_burst)
+        self._target_rate = target_rate
+        self._target_burst = target_burst
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._heap: List[_Outgoing] = []
+        self._seq = itertools.count()
+        self._space = asyncio.Semaphore(max_queue)
+        self._wakeup = asyncio.Event()
+        self._client = None
+        self._media = media
+        self._task: Optional[asyncio.Task] = None
+        self._sent = 0
+        self._failed = 0
+        self._max_delay = 0.0
+
+    def _bucket(self, target: str) -> TokenBucket:
+        bucket = self._buckets.get(target)
+        if bucket is None:
+            bucket = TokenBucket(self._target_rate, self._target_burst)
+            self._buckets[target] = bucket
+        return bucket
+
+    # 绑定连接并启动调度任务（重连后队列中未发出的消息继续发送）
+    def start(self, client) -> None:
+        self._client = client
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+
+    async def stop(self) -> None:
+        self._client = None
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    # 提交一条消息并等待 OneBot 的发送结果
+    async def send_msg(self, params: dict, priority: int = PRIORITY_REPLY,
+                       timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        :param timeout: 单条发送的响应超时（秒），None 时用连接的默认值；大图上传需要更长
+        """
+        await self._space.acquire()
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, _Outgoing(priority, next(self._seq), _target_of(params), params, fut, timeout))
+        self._wakeup.set()
+        return await fut
+
+    # 按优先级找到第一条目标令牌可用的消息；都不可用时返回最短等待时间
+    def _pick(self, now: float):
+        min_wait = None
+        for item in sorted(self._heap):
+            if item.future.cancelled():
+                return item, 0.0
+            wait = self._bucket(item.target).wait_time(now)
+            if wait == 0:
+                return item, 0.0
+            min_wait = wait if min_wait is None else min(min_wait, wait)
+        return None, min_wait
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            if not self._heap or self._client is None:
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            global_wait = self._global.wait_time(now)
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+                continue
+
+            item, wait = self._pick(now)
+            if item is None:
+                # 等到最早可发的目标，或有新消息进来时重新挑选
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._heap.remove(item)
+            heapq.heapify(self._heap)
+            self._space.release()
+
+            # 调用方已放弃等待（如断线被取消），不再发送
+            if item.future.cancelled():
+                continue
+
+            self._global.take(now)
+            self._bucket(item.target).take(now)
+            self._max_delay = max(self._max_delay, now - item.enqueued_at)
+            asyncio.create_task(self._deliver(self._client, item))
+
+    async def _deliver(self, client, item: _Outgoing) -> None:
+        try:
+            if self._media is None:
+                resp = await client.call("send_msg", item.params, timeout=item.timeout)
+            else:
+                resp = await self._deliver_media(client, item)
+            self._sent += 1
+            if not item.future.done():
+                item.future.set_result(resp)
+        except Exception as e:
+            self._failed += 1
+            if not item.future.done():
+                item.future.set_exception(e)
+
+    # 图片段换成已缓存的文件引用；引用失效时作废并按原内容重新排队（重发同样要拿令牌）
+    async def _deliver_media(self, client, item: _Outgoing) -> Dict[str, Any]:
+        prepared, pending, substituted = await self._media.prepare(item.params)
+        resp = await client.call("send_msg", prepared, timeout=item.timeout)
+        if substituted and resp.get("status") != "ok":
+            self._media.invalidate(substituted)
+            return await self.send_msg(item.params, item.priority, item.timeout)
+        if pending and resp.get("status") == "ok":
+            asyncio.create_task(self._media.learn(client, resp, pending))
+        return resp
+
+    # 获取发送统计信息（调试用）
+    def get_stats(self) -> dict:
+        return {
+            "queued": len(self._heap),
+            "queued_by_priority": {p: sum(1 for i in self._heap if i.priority == p) for p in sorted({i.priority for i in self._heap})},
+            "sent": self._sent,
+            "failed": self._failed,
+            "max_queue_delay": self._max_delay,
+            "targets": len(self._buckets),
+        }
+
+
+OUTBOUND = OutboundScheduler(
+    global_rate=config.OUTBOUND_GLOBAL_RATE,
+    global_burst=config.OUTBOUND_GLOBAL_BURST,
+    target_rate=config.OUTBOUND_TARGET_RATE,
+    target_burst=config.OUTBOUND_TARGET_BURST,
+    max_queue=config.OUTBOUND_MAX_QUEUE,
+    media=MEDIA,
+)
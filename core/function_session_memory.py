@@ -1,18 +1,165 @@
 from __future__ import annotations
+import asyncio
+import sys
 import time
+from collections import OrderedDict, deque
 from dataclasses import dataclass, field
-from typing import Dict, List, Optional
-from langchain_community.chat_message_histories import ChatMessageHistory
+from itertools import islice
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Sequence
 from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
 from config import SELF_USER_ID
+from core.function_tokens import MESSAGE_OVERHEAD_TOKENS, estimate_tokens
+
+
+# 群聊上下文（回复判定用）每行的默认最大长度
+DIALOG_LINE_MAX_CHARS = 240
+
+
+# 把一条消息渲染成一行对话文本；空消息返回 None
+def _render_dialog_line(msg: BaseMessage, max_chars: int = DIALOG_LINE_MAX_CHARS) -> Optional[str]:
+    content = getattr(msg, "content", "") or ""
+    content = content.strip() if isinstance(content, str) else str(content).strip()
+    if not content:
+        return None
+
+    line = f"BOT: {content}" if getattr(msg, "type", "") == "ai" else content
+    if max_chars and len(line) > max_chars:
+        line = line[:max_chars] + "…"
+    return line
+
+
+# 定长环形缓冲的聊天记录
+class RingChatMessageHistory(BaseChatMessageHistory):
+    """
+    - 最多保留 maxlen 条消息，超出时最旧的自动丢弃
+    - 同步维护预渲染好的对话行，回复判定时不必每次重新裁剪
+    - 每条消息的 token 数只在写入时估算一次
+    - window(n, token_budget) 返回只读视图，不复制消息
+    - 满了之后被挤出的旧消息交给 on_evict（用于滚动摘要）
+    """
+
+    def __init__(self, maxlen: int = 15, on_evict: Optional[Callable[[BaseMessage], None]] = None):
+        self.maxlen = maxlen
+        self._on_evict = on_evict
+        self._messages: Deque[BaseMessage] = deque(maxlen=maxlen)
+        self._lines: Deque[Optional[str]] = deque(maxlen=maxlen)
+        self._tokens: Deque[int] = deque(maxlen=maxlen)
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        return list(self._messages)
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __iter__(self):
+        return iter(self._messages)
+
+    def add_message(self, message: BaseMessage) -> None:
+        if self._on_evict is not None and len(self._messages) == self.maxlen:
+            self._on_evict(self._messages[0])
+        self._messages.append(message)
+        self._lines.append(_render_dialog_line(message))
+        self._tokens.append(estimate_tokens(message.content) + MESSAGE_OVERHEAD_TOKENS)
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        for message in messages:
+            self.add_message(message)
+
+    def clear(self) -> None:
+        self._messages.clear()
+        self._lines.clear()
+        self._tokens.clear()
+
+    # 原生异步接口：全是内存操作，不必像默认实现那样绕到线程池
+    async def aget_messages(self) -> List[BaseMessage]:
+        return self.messages
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self.add_messages(messages)
+
+    async def aclear(self) -> None:
+        self.clear()
+
+    # 最近 n 条消息
+    def tail(self, n: int) -> List[BaseMessage]:
+        n = min(n, len(self._messages))
+        return list(islice(self._messages, len(self._messages) - n, None))
+
+    # 从最新往前，在 token 预算内最多能放下几条（最多 n 条）
+    def count_within(self, n: int, token_budget: int) -> int:
+        count, used = 0, 0
+        for tokens in reversed(self._tokens):
+            if count >= n or used + tokens > token_budget:
+                break
+            used += tokens
+            count += 1
+        return count
+
+    # 最近 n 条消息的 token 数
+    def tail_tokens(self, n: int) -> int:
+        n = min(n, len(self._tokens))
+        return sum(islice(self._tokens, len(self._tokens) - n, None))
+
+    # 最近 n 条预渲染对话行（跳过空消息）
+    def tail_lines(self, n: int) -> List[str]:
+        n = min(n, len(self._lines))
+        return [line for line in islice(self._lines, len(self._lines) - n, None) if line]
+
+    def window(self, n: int, token_budget: Optional[int] = None) -> "HistoryWindow":
+        return HistoryWindow(self, n, token_budget)
+
+
+# 环形缓冲的只读窗口视图
+class HistoryWindow(BaseChatMessageHistory):
+    """
+    chain 读取时才取最近 n 条（给了 token_budget 时再按预算裁剪）；chain 回写的内容直接丢弃：
+    用户消息由 remember 写入、回复由 ai_completion 写入，
+    对冲请求中并发的多个 chain 也不会互相污染记忆。
+    """
+
+    def __init__(self, source: RingChatMessageHistory, n: int, token_budget: Optional[int] = None):
+        self._source = source
+        self._n = n
+        self._token_budget = token_budget
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        n = self._n
+        if self._token_budget is not None:
+            n = self._source.count_within(n, self._token_budget)
+        return self._source.tail(n)
+
+    def add_message(self, message: BaseMessage) -> None:
+        pass
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        pass
+
+    def clear(self) -> None:
+        pass
+
+    async def aget_messages(self) -> List[BaseMessage]:
+        return self.messages
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        pass
+
+    async def aclear(self) -> None:
+        pass
 
 
 @dataclass
 # 单个会话的短期记忆容器
 class SessionMemory:
-    history: BaseChatMessageHistory = field(default_factory=ChatMessageHistory)
+    history: RingChatMessageHistory = field(default_factory=RingChatMessageHistory)
     last_update_time: float = field(default_factory=time.time)
     is_initialized: bool = False
+    # 滚动摘要：被挤出窗口的旧消息折叠成的一段短文本
+    summary: str = ""
+    evicted: List[BaseMessage] = field(default_factory=list)
+    summarizing: bool = False
 
     def touch(self) -> None:
         self.last_update_time = time.time()
@@ -22,40 +169,183 @@ class SessionMemory:
             return False
         return (time.time() - self.last_update_time) > timeout
 
+    # 粗略估算占用内存（字节）：消息正文 + 每条消息对象的固定开销
+    def approx_bytes(self) -> int:
+        return sum(sys.getsizeof(getattr(m, "content", "")) + _MESSAGE_OVERHEAD for m in self.history)
+
+
+# 每条消息对象（BaseMessage + 元数据字典）的大致固定开销
+_MESSAGE_OVERHEAD = 600
+
+
 # 全局的短期记忆管理器
 class MemoryManager:
     def __init__(
             self,
             timeout: Optional[float] = None,
-            context_window: int = 15  # 提供给 LLM 的最大消息数
+            context_window: int = 15,  # 提供给 LLM 的最大消息数
+            max_sessions: int = 1000,
+            store=None,
+            summarizer: Optional[Callable[[str, List[str]], Awaitable[str]]] = None,
+            summary_batch: int = 6,
     ):
         """
         :param timeout: 会话超时时间（秒）
         :param context_window: 提供给 LLM 的最大消息数
+        :param max_sessions: 常驻会话数上限，超出时淘汰最久未活动的会话
+        :param store: 磁盘存储（SessionStore），不在内存中的会话从这里懒加载
+        :param summarizer: async (旧摘要, 被挤出的对话行) -> 新摘要；为 None 时不做摘要
+        :param summary_batch: 累积多少条被挤出的消息后更新一次摘要
         """
         self._timeout = timeout
         self._context_window = context_window
-        self._sessions: Dict[str, SessionMemory] = {}
+        self._max_sessions = max_sessions
+        # 按最近访问排序，最久未访问的在最前
+        self._sessions: "OrderedDict[str, SessionMemory]" = OrderedDict()
+        self._store = store
+        self._summarizer = summarizer
+        self._summary_batch = summary_batch
+        self._summaries = 0
+        self._evicted = 0
+        self._swept = 0
+
+    # 从磁盘恢复会话（已过期的不恢复）
+    def _load_from_store(self, session_id: str) -> Optional[SessionMemory]:
+        if self._store is None:
+            return None
+        try:
+            loaded = self._store.load(session_id, self._timeout)
+        except Exception as e:
+            print(f"⚠️ 读取会话存储失败: {e}")
+            return None
+        return self._install_loaded(session_id, loaded)
+
+    # 事件处理前预先在工作线程里加载会话，之后的同步访问直接命中内存
+    async def preload(self, session_id: str) -> None:
+        if self._store is None or session_id in self._sessions:
+            return
+        try:
+            loaded = await self._store.aload(session_id, self._timeout)
+        except Exception as e:
+            print(f"⚠️ 读取会话存储失败: {e}")
+            return
+        # 等待期间会话可能已被创建
+        if session_id in self._sessions:
+            return
+        if self._install_loaded(session_id, loaded) is None:
+            # 磁盘上也没有：直接建空会话，避免之后再同步查一次库
+            self._create_session(session_id)
+
+    def _install_loaded(self, session_id: str, loaded) -> Optional[SessionMemory]:
+        if loaded is None:
+            return None
+
+        rows, last_update, initialized, summary = loaded
+        session = self._new_session(session_id)
+        session.summary = summary
+        for role, content in rows:
+            session.history.add_message(AIMessage(content=content) if role == "ai" else HumanMessage(content=content))
+        session.last_update_time = last_update
+        session.is_initialized = initialized
+        self._sessions[session_id] = session
+        self._evict_over_limit()
+        print(f"💾 从磁盘恢复会话 {session_id}（{len(rows)} 条消息）")
+        return session
 
     # 获取或创建会话
     def get_or_create_session(self, session_id: str) -> SessionMemory:
 
         session = self._sessions.get(session_id)
+        if session is None:
+            session = self._load_from_store(session_id)
 
         # 会话过期处理：直接清空
         if session is not None and session.is_expired(self._timeout):
             print(f"⏰ 会话 {session_id} 已过期，清空记忆")
             session = None
+            if self._store is not None:
+                self._store.delete(session_id)
 
         # 创建新会话
         if session is None:
-            session = SessionMemory()
-            self._sessions[session_id] = session
-            print(f"🆕 创建新会话: {session_id}")
+            session = self._create_session(session_id)
 
+        self._sessions.move_to_end(session_id)
         session.touch()
         return session
 
+    def _create_session(self, session_id: str) -> SessionMemory:
+        session = self._new_session(session_id)
+        self._sessions[session_id] = session
+        print(f"🆕 创建新会话: {session_id}")
+        self._evict_over_limit()
+        return session
+
+    def _new_session(self, session_id: str) -> SessionMemory:
+        session = SessionMemory()
+        on_evict = None
+        if self._summarizer is not None:
+            on_evict = lambda msg: self._on_evict(session_id, session, msg)
+        session.history = RingChatMessageHistory(self._context_window, on_evict=on_evict)
+        return session
+
+    # 窗口满了被挤出的消息：攒够一批后在后台折叠进摘要
+    def _on_evict(self, session_id: str, session: SessionMemory, msg: BaseMessage) -> None:
+        session.evicted.append(msg)
+        if session.summarizing or len(session.evicted) < self._summary_batch:
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        session.summarizing = True
+        asyncio.create_task(self._summarize(session_id, session))
+
+    async def _summarize(self, session_id: str, session: SessionMemory) -> None:
+        batch, session.evicted = session.evicted, []
+        try:
+            lines = [line for line in (_render_dialog_line(m) for m in batch) if line]
+            if lines:
+                session.summary = (await self._summarizer(session.summary, lines)).strip()
+                self._summaries += 1
+                if self._store is not None:
+                    self._store.set_summary(session_id, session.summary)
+        except Exception as e:
+            # 失败时放回，下次一起摘要（最多保留几批，避免无限增长）
+            session.evicted = (batch + session.evicted)[-self._summary_batch * 4:]
+            print(f"⚠️ 会话 {session_id} 摘要失败: {e}")
+        finally:
+            session.summarizing = False
+
+    # 当前会话的滚动摘要（没有时为空串）
+    def get_summary(self, session_id: str) -> str:
+        return self.get_or_create_session(session_id).summary
+
+    # 超出上限时淘汰最久未活动的会话
+    def _evict_over_limit(self) -> None:
+        while self._max_sessions and len(self._sessions) > self._max_sessions:
+            session_id, _ = self._sessions.popitem(last=False)
+            self._evicted += 1
+            print(f"🧹 会话数超过上限，淘汰: {session_id}")
+
+    # 清理所有已过期的会话，返回清理数量
+    def sweep_expired(self) -> int:
+        expired = [sid for sid, s in self._sessions.items() if s.is_expired(self._timeout)]
+        for sid in expired:
+            del self._sessions[sid]
+            if self._store is not None:
+                self._store.delete(sid)
+        self._swept += len(expired)
+        return len(expired)
+
+    # 后台定期清理过期会话（随连接启动，断线时取消）
+    async def run_sweeper(self, interval: float = 60.0) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            removed = self.sweep_expired()
+            if removed:
+                print(f"🧹 已清理 {removed} 个过期会话，剩余 {len(self._sessions)} 个")
+
     def initialize_with_history(
             self,
             session_id: str,
@@ -114,23 +404,32 @@ class MemoryManager:
                 continue
 
         session.is_initialized = True
+        self._persist_all(session_id, session)
         print(f"📚 会话 {session_id} 已初始化，加载了 {len(messages)} 条历史")
 
-    def get_history(self, session_id: str) -> BaseChatMessageHistory:
-        session = self.get_or_create_session(session_id)
+    def _persist_all(self, session_id: str, session: SessionMemory) -> None:
+        if self._store is not None:
+            self._store.replace(session_id, [(m.type, m.content) for m in session.history], session.is_initialized)
 
-        all_messages = session.history.messages
+    def _persist_message(self, session_id: str, session: SessionMemory, role: str, text: str) -> None:
+        if self._store is not None:
+            self._store.append(session_id, role, text, session.is_initialized)
 
-        # 如果消息数不超过限制，直接返回
-        if len(all_messages) <= self._context_window:
-            return session.history
-
-        # 裁剪：只保留最近的消息
-        limited_history = ChatMessageHistory()
-        for msg in all_messages[-self._context_window:]:
-            limited_history.add_message(msg)
+    def get_history(self, session_id: str, history_budget: int = 0) -> BaseChatMessageHistory:
+        """
+        返回最近消息的只读视图（见 HistoryWindow）：
+        最多 context_window 条；history_budget > 0 时再按 token 预算从新到旧裁剪。
+        """
+        session = self.get_or_create_session(session_id)
+        return session.history.window(self._context_window, history_budget or None)
 
-        return limited_history
+    # 按 token 预算实际会放进 prompt 的历史 token 数
+    def get_history_tokens(self, session_id: str, history_budget: int = 0) -> int:
+        history = self.get_or_create_session(session_id).history
+        n = self._context_window
+        if history_budget:
+            n = history.count_within(n, history_budget)
+        return history.tail_tokens(n)
 
     def add_user_message(self, session_id: str, text: str) -> None:
         if not text:
@@ -138,6 +437,7 @@ class MemoryManager:
         session = self.get_or_create_session(session_id)
         session.history.add_user_message(text)
         session.touch()
+        self._persist_message(session_id, session, "human", text)
 
     def add_ai_message(self, session_id: str, text: str) -> None:
         if not text:
@@ -145,56 +445,66 @@ class MemoryManager:
         session = self.get_or_create_session(session_id)
         session.history.add_ai_message(text)
         session.touch()
+        self._persist_message(session_id, session, "ai", text)
 
     def get_recent_dialog_lines(
             self,
             session_id: str,
             take_n: int = 10,
-            max_chars_per_line: int = 240,
+            max_chars_per_line: int = DIALOG_LINE_MAX_CHARS,
     ) -> List[str]:
-        # 获取最近的对话
+        # 获取最近的对话；默认长度直接用预渲染好的行
         session = self.get_or_create_session(session_id)
-        messages = session.history.messages[-take_n:]
+        if max_chars_per_line == DIALOG_LINE_MAX_CHARS:
+            return session.history.tail_lines(take_n)
 
         lines: List[str] = []
-        for msg in messages:
-            role = getattr(msg, "type", "")
-            content = (getattr(msg, "content", "") or "").strip()
-
-            if not content:
-                continue
-
-            if role == "ai":
-                line = f"BOT: {content}"
-            else:
-                line = content
-
-            if max_chars_per_line and len(line) > max_chars_per_line:
-                line = line[:max_chars_per_line] + "…"
-
-            lines.append(line)
-
+        for msg in session.history.tail(take_n):
+            line = _render_dialog_line(msg, max_chars_per_line)
+            if line:
+                lines.append(line)
         return lines
 
     # 检查会话是否已初始化
     def is_session_initialized(self, session_id: str) -> bool:
-        session = self._sessions.get(session_id)
+        session = self._sessions.get(session_id) or self._load_from_store(session_id)
         return session is not None and session.is_initialized
 
     # 手动重置会话
     def reset_session(self, session_id: str) -> SessionMemory:
-        session = SessionMemory()
+        session = self._new_session(session_id)
         self._sessions[session_id] = session
+        self._sessions.move_to_end(session_id)
+        self._evict_over_limit()
+        if self._store is not None:
+            self._store.delete(session_id)
         print(f"🔄 手动重置会话: {session_id}")
         return session
-    # 获取会话统计信息（调试用）
-    def get_stats(self, session_id: str) -> dict:
+
+    # 获取会话统计信息（调试用）；不传 session_id 时返回全局统计
+    def get_stats(self, session_id: Optional[str] = None) -> dict:
+        if session_id is None:
+            sizes = {sid: s.approx_bytes() for sid, s in self._sessions.items()}
+            largest = sorted(sizes.items(), key=lambda kv: kv[1], reverse=True)[:5]
+            return {
+                "sessions": len(self._sessions),
+                "max_sessions": self._max_sessions,
+                "evicted": self._evicted,
+                "swept": self._swept,
+                "summaries": self._summaries,
+                "messages": sum(len(s.history) for s in self._sessions.values()),
+                "approx_bytes": sum(sizes.values()),
+                "largest_sessions": largest,
+            }
+
         session = self._sessions.get(session_id)
         if not session:
             return {"exists": False}
         return {
             "exists": True,
-            "active_messages": len(session.history.messages),
+            "active_messages": len(session.history),
+            "approx_bytes": session.approx_bytes(),
+            "summary_chars": len(session.summary),
             "is_initialized": session.is_initialized,
             "is_expired": session.is_expired(self._timeout),
             "age_seconds": time.time() - session.last_update_time
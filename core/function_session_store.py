@@ -0,0 +1,193 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+
+
+# 短期记忆的磁盘存储（SQLite WAL）
+class SessionStore:
+    """
+    重启 / 重连后不必再为每个会话拉一遍历史：
+    - 每条消息写入时先进内存队列，由后台任务批量提交（一次事务）
+    - 每个会话只保留最近 keep 条消息
+    - 会话第一次被访问时才从磁盘加载（懒加载），还没提交的写入直接叠加在读到的结果上，不必先 flush
+    """
+
+    def __init__(self, path: str, keep: int = 40):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._keep = keep
+        self._lock = threading.Lock()
+        self._queue_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                last_update REAL NOT NULL,
+                initialized INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, seq);
+        """)
+        # 旧库补上摘要列
+        try:
+            self._conn.execute("ALTER TABLE sessions ADD COLUMN summary TEXT NOT NULL DEFAULT ''")
+        except sqlite3.OperationalError:
+            pass
+        self._conn.commit()
+        self._pending: List[Tuple] = []
+        self._stats = {"loads": 0, "load_hits": 0, "expired_on_load": 0, "writes": 0, "flushes": 0}
+
+    # ---------- 写入（进队列，flush 时批量提交） ----------
+    def _enqueue(self, op: Tuple) -> None:
+        with self._queue_lock:
+            self._pending.append(op)
+
+    def append(self, session_id: str, role: str, content: str, initialized: bool) -> None:
+        self._enqueue(("append", session_id, role, content, time.time(), int(initialized)))
+
+    def replace(self, session_id: str, messages: List[Tuple[str, str]], initialized: bool) -> None:
+        self._enqueue(("replace", session_id, messages, time.time(), int(initialized)))
+
+    def delete(self, session_id: str) -> None:
+        self._enqueue(("delete", session_id))
+
+    def set_summary(self, session_id: str, summary: str) -> None:
+        self._enqueue(("summary", session_id, summary))
+
+    def flush(self) -> int:
+        """提交队列中的写入，返回提交的操作数（可在工作线程中调用）"""
+        # 取出队列与写库在同一把锁内完成，load 不会看到“已出队未提交”的中间状态
+        with self._lock:
+            with self._queue_lock:
+                ops, self._pending = self._pending, []
+            if not ops:
+                return 0
+            cur = self._conn.cursor()
+            touched = set()
+            for op in ops:
+                kind, session_id = op[0], op[1]
+                if kind == "append":
+                    _, _, role, content, ts, initialized = op
+                    cur.execute("INSERT INTO messages(session_id, role, content) VALUES (?, ?, ?)",
+                                (session_id, role, content))
+                    self._upsert_session(cur, session_id, ts, initialized)
+                    touched.add(session_id)
+                elif kind == "replace":
+                    _, _, messages, ts, initialized = op
+                    cur.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                    cur.executemany("INSERT INTO messages(session_id, role, content) VALUES (?, ?, ?)",
+                                    [(session_id, role, content) for role, content in messages[-self._keep:]])
+                    self._upsert_session(cur, session_id, ts, initialized)
+                elif kind == "summary":
+                    cur.execute("UPDATE sessions SET summary = ? WHERE session_id = ?", (op[2], session_id))
+                elif kind == "delete":
+                    cur.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                    cur.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+                    touched.discard(session_id)
+
+            # 每个会话只留最近 keep 条
+            for session_id in touched:
+                cur.execute("""
+                    DELETE FROM messages WHERE session_id = ? AND seq <= (
+                        SELECT seq FROM messages WHERE session_id = ? ORDER BY seq DESC LIMIT 1 OFFSET ?
+                    )""", (session_id, session_id, self._keep))
+            self._conn.commit()
+        self._stats["writes"] += len(ops)
+        self._stats["flushes"] += 1
+        return len(ops)
+
+    @staticmethod
+    def _upsert_session(cur, session_id: str, ts: float, initialized: int) -> None:
+        cur.execute("""
+            INSERT INTO sessions(session_id, last_update, initialized) VALUES (?, ?, ?)
+            ON CONFLICT(session_id) DO UPDATE SET
+                last_update = excluded.last_update,
+                initialized = MAX(sessions.initialized, excluded.initialized)
+        """, (session_id, ts, initialized))
+
+    # 后台定期批量提交
+    async def run_flusher(self, interval: float = 1.0) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                print(f"⚠️ 写入会话存储失败: {e}")
+
+    # ---------- 读取 ----------
+    def load(self, session_id: str, timeout: Optional[float] = None):
+        """
+        返回 (消息列表[(role, content)], last_update, initialized, summary)；
+        不存在或已过期（过期的顺便删除）时返回 None
+        """
+        self._stats["loads"] += 1
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT last_update, initialized, summary FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            messages = []
+            if row is not None:
+                messages = self._conn.execute(
+                    "SELECT role, content FROM messages WHERE session_id = ? ORDER BY seq", (session_id,)
+                ).fetchall()
+            with self._queue_lock:
+                pending = [op for op in self._pending if op[1] == session_id]
+
+        # 叠加还在队列里的写入，保证读到最新（与 flush 的处理一致）
+        exists = row is not None
+        last_update, initialized, summary = row if exists else (0.0, 0, "")
+        for op in pending:
+            kind = op[0]
+            if kind == "append":
+                _, _, role, content, last_update, op_initialized = op
+                messages.append((role, content))
+                initialized, exists = max(initialized, op_initialized), True
+            elif kind == "replace":
+                _, _, replaced, last_update, op_initialized = op
+                messages = list(replaced)
+                initialized, exists = max(initialized, op_initialized), True
+            elif kind == "summary" and exists:
+                summary = op[2]
+            elif kind == "delete":
+                messages, last_update, initialized, summary, exists = [], 0.0, 0, "", False
+
+        if not exists:
+            return None
+        if timeout and timeout > 0 and time.time() - last_update > timeout:
+            self._stats["expired_on_load"] += 1
+            self._enqueue(("delete", session_id))
+            return None
+        self._stats["load_hits"] += 1
+        return messages[-self._keep:], last_update, bool(initialized), summary or ""
+
+    # 在工作线程里读取，不阻塞事件循环
+    async def aload(self, session_id: str, timeout: Optional[float] = None):
+        return await asyncio.to_thread(self.load, session_id, timeout)
+
+    # 启动时清掉已过期的会话
+    def purge_expired(self, timeout: Optional[float]) -> int:
+        if not timeout or timeout <= 0:
+            return 0
+        cutoff = time.time() - timeout
+        with self._lock:
+            expired = [r[0] for r in self._conn.execute(
+                "SELECT session_id FROM sessions WHERE last_update < ?", (cutoff,))]
+            self._conn.executemany("DELETE FROM messages WHERE session_id = ?", [(s,) for s in expired])
+            self._conn.execute("DELETE FROM sessions WHERE last_update < ?", (cutoff,))
+            self._conn.commit()
+        return len(expired)
+
+    # 获取存储统计信息（调试用）
+    def get_stats(self) -> dict:
+        with self._lock:
+            sessions = self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+        return {**self._stats, "stored_sessions": sessions, "pending_writes": len(self._pending)}
@@ -0,0 +1,9 @@
+from typing import Iterable, Optional
+
+
+# 样本的 p 分位数（取排序后第 int(n * p) 个）；没有样本时返回 default
+def percentile(samples: Iterable[float], p: float, default: Optional[float] = None) -> Optional[float]:
+    ordered = sorted(samples)
+    if not ordered:
+        return default
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
@@ -0,0 +1,62 @@
+import re
+from collections import deque
+from typing import Deque, Dict
+
+
+# 中日韩字符、全角标点：大致一个字一个 token；其余按 4 个字符一个 token 估算
+_CJK_RE = re.compile(r"[　-〿぀-ヿ㐀-䶿一-鿿가-힯＀-￯]")
+
+# 每条消息的角色 / 分隔符开销
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+# 估算文本的 token 数（不依赖具体模型的分词器）
+def estimate_tokens(text) -> int:
+    if not text:
+        return 0
+    if not isinstance(text, str):
+        text = str(text)
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+# 按 token 预算截断文本
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    if max_tokens <= 0:
+        return ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+
+    cost = 0.0
+    for i, ch in enumerate(text):
+        cost += 1 if _CJK_RE.match(ch) else 0.25
+        if cost > max_tokens - 1:
+            return text[:i] + "…"
+    return text
+
+
+# 每次请求的 prompt token 统计
+class PromptTokenStats:
+    def __init__(self, samples: int = 256):
+        self._samples: Deque[Dict[str, int]] = deque(maxlen=samples)
+        self._requests = 0
+
+    def record(self, **parts: int) -> int:
+        total = sum(parts.values())
+        self._samples.append({**parts, "total": total})
+        self._requests += 1
+        return total
+
+    def snapshot(self) -> dict:
+        if not self._samples:
+            return {"requests": self._requests}
+        keys = self._samples[-1].keys()
+        avg = {k: round(sum(s.get(k, 0) for s in self._samples) / len(self._samples)) for k in keys}
+        return {
+            "requests": self._requests,
+            "avg": avg,
+            "max_total": max(s["total"] for s in self._samples),
+        }
+
+
+PROMPT_TOKEN_STATS = PromptTokenStats()
@@ -4,6 +4,15 @@ import websockets
 from config import FORTUNE_GROUPS
 from core.function import *
 from core.function_fortune import setup_daily_fortune_scheduler
+from core.function_dispatcher import SessionDispatcher
+from core.function_coalesce import BurstCoalescer
+from core.function_onebot import OneBotClient
+from core.function_outbound import OUTBOUND, PRIORITY_REPLY, PRIORITY_COMMAND, PRIORITY_EMOJI
+from core.function_media import MEDIA
+from core.function_session_store import SessionStore
+from core.function_hedge import RaceStats, hedged_race
+from core.function_model_health import MODEL_HEALTH, is_timeout_error
+from core.function_tokens import PROMPT_TOKEN_STATS, estimate_tokens
 
 HTTPX_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=20.0)
 HTTPX_TIMEOUT = httpx.Timeout(connect=5.0, read=12.0, write=5.0, pool=5.0)
@@ -17,102 +26,267 @@ LLM_KEY = CURRENT_LLM["KEY"]
 template_ask_messages = [
     {"role": "system", "content": [{"type": "text", "text": config.PROMPT[0] + config.PROMPT[config.CURRENT_PROMPT]}]}]
 system_prompt = config.PROMPT[0] + config.PROMPT[config.CURRENT_PROMPT]
+SYSTEM_PROMPT_TOKENS = estimate_tokens(system_prompt)
+
+# 短期记忆落盘：重启后按会话懒加载，不必重新拉取历史
+session_store = SessionStore(config.SESSION_STORE_PATH, keep=config.CONTEXT_MAX_MESSAGES) if config.SESSION_STORE_PATH else None
+if session_store is not None:
+    print(f"🧹 清理了 {session_store.purge_expired(config.HISTORY_TIMEOUT)} 个已过期的会话存储")
+
+# 启动到首次回复的耗时（对比冷启动：每个会话都要拉取历史）
+WARM_START = {"started": time.perf_counter(), "history_fetches": 0, "first_reply": None}
 
 memory_pool = LocalDictStore()
 memory_manager = MemoryManager(
     timeout=config.HISTORY_TIMEOUT,
-    context_window=15
+    context_window=config.CONTEXT_MAX_MESSAGES,
+    max_sessions=config.SESSION_MAX,
+    store=session_store,
+    summarizer=summarize_dialog if config.SUMMARY_ENABLED else None,
+    summary_batch=config.SUMMARY_BATCH,
 )
 
 
+# 候选模型的胜负与耗时统计（对冲请求用）
+MODEL_RACE_STATS = RaceStats()
+
+
+# 对冲延迟：固定秒数，或按刚启动模型的近期 p95 耗时
+def _hedge_delay(model_name):
+    if config.LLM_HEDGE_DELAY == "p95":
+        p95 = MODEL_RACE_STATS.percentile(model_name, 0.95)
+        return p95 if p95 is not None else config.LLM_HEDGE_DEFAULT_DELAY
+    return config.LLM_HEDGE_DELAY
+
+
+# 取出流式分块中的文本
+def _chunk_text(chunk):
+    content = getattr(chunk, "content", chunk)
+    return content if isinstance(content, str) else ""
+
+
+# 回复写入短期记忆，并异步更新长期记忆
+def _remember_reply(session_id, user_id, user_input, content):
+    # 把回复加入短期记忆
+    memory_manager.add_ai_message(session_id, content)
+
+    # 异步更新长期记忆
+    try:
+        asyncio.create_task(
+            asyncio.to_thread(
+                memory_pool.add_turn,
+                user_id=user_id,
+                user_text=user_input,
+                assistant_text=content
+            )
+        )
+    except Exception as e:
+        print("⚠️ [ai_completion] mem0 add_turn 失败：", e)
+
+
 # 大模型请求器(注意message不能为空!)
-async def ai_completion(session_id, user_input):
+async def ai_completion(session_id, user_input, images=None, on_segment=None):
+    """
+    :param images: 本轮附带的图片消息（resolve_image_messages 的结果）
+    :param on_segment: 传入时走流式模式，每切出一段就 await on_segment(text) 发送；
+                       返回值仍是完整回复（已发送的各段拼接）
+    """
     try:
         user_id = session_id.split(":", 1)[-1] if ":" in session_id else session_id
 
-        # 获取长期记忆
-        long_mem = get_long_memory_text(memory_pool, user_id, user_input)
+        # 获取长期记忆（限制在长期记忆预算内）
+        long_mem = await get_long_memory_text(memory_pool, user_id, user_input, max_tokens=config.LONG_MEMORY_TOKEN_BUDGET)
+
+        # 更早对话的滚动摘要
+        summary = memory_manager.get_summary(session_id) or "（无）"
+
+        # token 预算：总预算扣掉系统提示、长期记忆、摘要和本轮输入，剩下的给短期历史
+        long_mem_tokens = estimate_tokens(long_mem)
+        summary_tokens = estimate_tokens(summary)
+        input_tokens = estimate_tokens(user_input)
+        history_budget = max(
+            config.HISTORY_MIN_TOKENS,
+            config.CONTEXT_TOKEN_BUDGET - SYSTEM_PROMPT_TOKENS - long_mem_tokens - summary_tokens - input_tokens,
+        )
+        prompt_tokens = PROMPT_TOKEN_STATS.record(
+            system=SYSTEM_PROMPT_TOKENS,
+            long_memory=long_mem_tokens,
+            summary=summary_tokens,
+            history=memory_manager.get_history_tokens(session_id, history_budget),
+            input=input_tokens,
+        )
+        out("🧮 [ai_completion] prompt tokens ≈", f"{prompt_tokens}（历史预算 {history_budget}）")
 
         out("🏁 [ai_completion] 调用 chain, session:", session_id)
         out("📝 [ai_completion] 用户输入:", user_input[:100])
 
-        # 解析候选模型列表
+        # 解析候选模型列表，按健康度重排并跳过熔断中的模型
         names = [s.strip() for s in str(LLM_NAME).split(",") if s.strip()]
-
-        last_err = None
-        for model_name in names:
-            try:
-                # 为当前模型创建临时配置
-                temp_config = CURRENT_LLM.copy()
-                temp_config["NAME"] = model_name
-
-                # 动态创建 chain
-                chain = create_chat_chain_with_memory(
-                    memory_manager=memory_manager,
-                    long_memory_pool=memory_pool,
-                    system_prompt=system_prompt,
-                    llm_config=temp_config
-                )
-
-                # 调用 chain
-                response = await asyncio.to_thread(
-                    chain.invoke,
-                    {"input": user_input, "long_memory": long_mem},
-                    config={"configurable": {"session_id": session_id}}
-                )
-
-                # 提取回复内容
-                content = response.content if hasattr(response, 'content') else str(response)
-                if not content:
-                    content = "嗯"
-
-                out("短期记忆：", memory_manager.get_or_create_session(session_id).history)
-                out("原始信息：", content)
-                out("✅ 使用模型：", model_name)
-
-                # 把回复加入短期记忆
-                memory_manager.add_ai_message(session_id, content)
-
-                # 异步更新长期记忆
-                try:
-                    asyncio.create_task(
-                        asyncio.to_thread(
-                            memory_pool.add_turn,
-                            user_id=user_id,
-                            user_text=user_input,
-                            assistant_text=content
-                        )
-                    )
-                except Exception as e:
-                    print("⚠️ [ai_completion] mem0 add_turn 失败：", e)
-
-                return content
-
-            except Exception as e:
-                last_err = e
+        names = MODEL_HEALTH.order(names)
+
+        chain_input = {"input": user_input, "long_memory": long_mem, "summary": summary, "images": images or []}
+        chain_config = {"configurable": {"session_id": session_id, "history_budget": history_budget}}
+
+        # 获取（缓存的）chain
+        def _chain_for(model_name):
+            if not MODEL_HEALTH.acquire(model_name):
+                raise RuntimeError(f"模型 {model_name} 熔断中")
+
+            # 为当前模型创建临时配置
+            temp_config = CURRENT_LLM.copy()
+            temp_config["NAME"] = model_name
+
+            return create_chat_chain_with_memory(
+                memory_manager=memory_manager,
+                long_memory_pool=memory_pool,
+                system_prompt=system_prompt,
+                llm_config=temp_config
+            )
+
+        def _on_error(model_name, started, e):
+            COMPLETION_STATS.end(started, ok=False)
+            if isinstance(e, asyncio.CancelledError):
+                MODEL_HEALTH.record_cancelled(model_name)
+            else:
+                MODEL_HEALTH.record_failure(model_name, timeout=is_timeout_error(e))
                 print(f"⚠️ 模型 {model_name} 失败: {e}")
-                continue
 
-        # 所有模型都失败
-        print(f"⚠️ [ai_completion] 全部候选模型失败: {last_err}")
-        return None
+        async def _run(model_name):
+            chain = _chain_for(model_name)
+
+            # 调用 chain（原生异步，不占用线程池）
+            started = COMPLETION_STATS.begin()
+            try:
+                response = await chain.ainvoke(chain_input, config=chain_config)
+            except (asyncio.CancelledError, Exception) as e:
+                _on_error(model_name, started, e)
+                raise
+            MODEL_HEALTH.record_success(model_name, COMPLETION_STATS.end(started))
+
+            # 提取回复内容
+            content = response.content if hasattr(response, 'content') else str(response)
+            return content or "嗯"
+
+        # 流式：拿到第一个非空分块才算“返回”，对冲比较的是首包速度
+        async def _run_stream(model_name):
+            chain = _chain_for(model_name)
+
+            started = COMPLETION_STATS.begin()
+            stream = chain.astream(chain_input, config=chain_config)
+            try:
+                async for chunk in stream:
+                    text = _chunk_text(chunk)
+                    if text:
+                        return stream, text, started
+                return stream, "", started
+            except (asyncio.CancelledError, Exception) as e:
+                _on_error(model_name, started, e)
+                await stream.aclose()
+                raise
+
+        # 同一轮落选的流：关闭连接，结束统计并释放（可能是半开探测的）健康度名额
+        async def _discard_stream(model_name, result):
+            stream, _, started = result
+            COMPLETION_STATS.end(started, ok=False)
+            MODEL_HEALTH.record_cancelled(model_name)
+            await stream.aclose()
+
+        # 对冲请求：主模型迟迟没有结果时并行启动下一个，取最先返回的有效答案
+        started = time.perf_counter()
+        try:
+            model_name, result = await hedged_race(
+                names,
+                _run if on_segment is None else _run_stream,
+                delay=_hedge_delay if config.LLM_HEDGE_DELAY is not None else None,
+                stats=MODEL_RACE_STATS,
+                discard=None if on_segment is None else _discard_stream,
+            )
+        except Exception as e:
+            # 所有模型都失败
+            print(f"⚠️ [ai_completion] 全部候选模型失败: {e}")
+            return None
+
+        if on_segment is None:
+            content = result
+            elapsed = time.perf_counter() - started
+            out("✅ 使用模型：", f"{model_name} 耗时 {elapsed:.2f}s")
+        else:
+            content = await _consume_stream(model_name, result, on_segment, started)
+            if not content:
+                return None
+
+        out("短期记忆：", memory_manager.get_or_create_session(session_id).history)
+        out("原始信息：", content)
+
+        _remember_reply(session_id, user_id, user_input, content)
+        return content
 
     except Exception as e:
         print(f"⚠️ [ai_completion] 调用 LLM 发生错误: {e}")
         return None
 
 
+# 消费获胜模型的剩余流：按句切分，首段立即发送，后续段节流发送
+async def _consume_stream(model_name, result, on_segment, request_started):
+    stream, first, model_started = result
+    first_segment_at = None
+
+    async def _emit(text):
+        nonlocal first_segment_at
+        if first_segment_at is None:
+            # 首段耗时从请求开始计（含长期记忆检索与首包等待）
+            first_segment_at = STREAM_FIRST_SEGMENT_STATS.observe(time.perf_counter() - request_started)
+        await on_segment(text)
+
+    streamer = SentenceStreamer(
+        _emit,
+        min_chars=config.STREAM_MIN_SEGMENT_CHARS,
+        followups=config.STREAM_FOLLOWUPS,
+        followup_interval=config.STREAM_FOLLOWUP_INTERVAL,
+    )
+    ok = True
+    try:
+        await streamer.feed(first)
+        async for chunk in stream:
+            await streamer.feed(_chunk_text(chunk))
+        MODEL_HEALTH.record_success(model_name, COMPLETION_STATS.end(model_started))
+    except Exception as e:
+        # 中途断流：已发送的内容无法撤回，把缓冲里剩下的也发出去
+        ok = False
+        COMPLETION_STATS.end(model_started, ok=False)
+        MODEL_HEALTH.record_failure(model_name, timeout=is_timeout_error(e))
+        print(f"⚠️ 模型 {model_name} 流式输出中断: {e}")
+    finally:
+        await stream.aclose()
+
+    await streamer.flush()
+    if not streamer.sent and ok:
+        await streamer.feed("嗯")
+        await streamer.flush()
+
+    total = STREAM_TOTAL_STATS.observe(time.perf_counter() - request_started, ok=bool(streamer.sent))
+    if first_segment_at is not None:
+        out("✅ 使用模型：", f"{model_name} 首段 {first_segment_at:.2f}s / 总耗时 {total:.2f}s / {len(streamer.sent)} 段")
+    return streamer.text
+
+
 # QQ 消息发送器
-async def send_message(websocket, params):
+async def send_message(params, priority=PRIORITY_REPLY):
     try:
         if params is None:
             raise ValueError("params is None")
 
-        await websocket.send(json.dumps({
-            "action": "send_msg",
-            "params": params
-        }))
-
+        # 经由出站调度器：限速 + 优先级排队
+        resp = await OUTBOUND.send_msg(params, priority)
+        if resp.get("status") != "ok":
+            print(f"⚠️ [send_message] 发送失败: {resp.get('wording') or resp.get('message') or resp.get('retcode')}")
+        elif priority == PRIORITY_REPLY and WARM_START["first_reply"] is None:
+            WARM_START["first_reply"] = time.perf_counter() - WARM_START["started"]
+            print(f"⏱️ 启动到首次回复 {WARM_START['first_reply']:.2f}s（期间拉取历史 {WARM_START['history_fetches']} 次）")
+        return resp
+
+    except asyncio.TimeoutError:
+        print("⚠️ [send_message] 等待发送结果超时")
     except websockets.exceptions.WebSocketException as e:
         # 捕获 WebSocket 相关异常
         print(f"⚠️ [send_message] WebSocket 错误: {e}")
@@ -121,14 +295,16 @@ async def send_message(websocket, params):
         print(f"⚠️ [send_message] 发送消息时发生错误: {e}")
 
 # 记忆函数
-async def remember(websocket, event):
+async def remember(client, event):
     try:
         session_id = calc_session_id(event)
+        await memory_manager.preload(session_id)
 
-        # 如果会话未初始化，先拉取历史
+        # 如果会话未初始化（内存和磁盘里都没有），先拉取历史
         if not memory_manager.is_session_initialized(session_id):
             print(f"🔍 首次记忆，正在拉取历史消息...")
-            history_msgs = await get_nearby_message(websocket, event, CURRENT_LLM)
+            WARM_START["history_fetches"] += 1
+            history_msgs = await get_nearby_message(client, event)
             if history_msgs:
                 memory_manager.initialize_with_history(session_id, history_msgs)
 
@@ -136,7 +312,7 @@ async def remember(websocket, event):
         nickname = event.get("sender").get("nickname")
 
         # 处理消息，提取文本
-        msgs = process_single_message(message, nickname, CURRENT_LLM)
+        msgs = process_single_message(message, nickname)
 
         for msg in msgs:
             role = msg.get("role")
@@ -148,7 +324,7 @@ async def remember(websocket, event):
                 if isinstance(part, dict):
                     if part.get("type") == "text":
                         text_parts.append(part.get("text", ""))
-                    elif part.get("type") == "image_url":
+                    elif part.get("type") in ("image_ref", "image_url"):
                         text_parts.append("[图片]")
 
             text = "".join(text_parts).strip()
@@ -159,8 +335,36 @@ async def remember(websocket, event):
     except Exception as e:
         print(f"⚠️ [remember] 异常: {e}")
 
-# 处理消息事件并发送回复
-async def handle_message(websocket, event):
+# 从 event 提取用户输入（remember 已经加入记忆，这里只提取文本）
+def extract_user_input(event):
+    message = event.get("message")
+    nickname = event.get("sender").get("nickname")
+    msgs = process_single_message(message, nickname)
+
+    # 提取最后一条用户文本
+    user_input = ""
+    for msg in reversed(msgs):
+        if msg.get("role") == "user":
+            for part in msg.get("content", []):
+                if isinstance(part, dict) and part.get("type") == "text":
+                    user_input += part.get("text", "")
+            if user_input:
+                break
+    return user_input
+
+
+# 从 event 提取图片引用
+def extract_image_urls(event):
+    urls = []
+    for msg in process_single_message(event.get("message"), ""):
+        for part in msg.get("content", []):
+            if isinstance(part, dict) and part.get("type") == "image_ref" and part.get("url"):
+                urls.append(part["url"])
+    return urls
+
+
+# 处理消息事件并发送回复（events 为合并窗口内的全部触发，回复最后一条）
+async def handle_message(client, event, events=None):
     try:
         from core.function import calc_session_id
         session_id = calc_session_id(event)
@@ -168,36 +372,39 @@ async def handle_message(websocket, event):
         msg_type = event.get("message_type")
         out("⏳ 当前会话:", session_id)
 
-        # 从 event 提取用户输入（remember 已经加入记忆，这里只提取文本）
-        message = event.get("message")
-        nickname = event.get("sender").get("nickname")
-        msgs = process_single_message(message, nickname, CURRENT_LLM)
+        # 合并的多条触发一起作为本轮输入
+        events = events or [event]
+        texts = [extract_user_input(ev) for ev in events]
+        user_input = "\n".join(t for t in texts if t)
 
-        # 提取最后一条用户文本
-        user_input = ""
-        for msg in reversed(msgs):
-            if msg.get("role") == "user":
-                for part in msg.get("content", []):
-                    if isinstance(part, dict) and part.get("type") == "text":
-                        user_input += part.get("text", "")
-                if user_input:
-                    break
+        # 只有真正触发回复的消息才下载图片（且仅限视觉模型）
+        images = await resolve_image_messages(
+            [url for ev in events for url in extract_image_urls(ev)],
+            CURRENT_LLM,
+        )
 
         if not user_input:
             user_input = "[无文本内容]"
 
+        # 流式模式：边生成边按句子发送
+        async def _send_segment(segment):
+            await send_message(build_params("text", event, segment))
+
+        on_segment = _send_segment if config.LLM_STREAM_REPLY else None
+
         # 调用 chain 生成回复
-        content = await ai_completion(session_id, user_input)
+        content = await ai_completion(session_id, user_input, images=images, on_segment=on_segment)
 
         if not content:
             return
 
-        # 发送回复
-        await send_message(websocket, build_params("text", event, content))
+        # 发送回复（流式模式下已经发过）
+        if on_segment is None:
+            await send_message(build_params("text", event, content))
 
         # 随机发送表情
         if ran_emoji():
-            await send_message(websocket, ran_emoji_content(event))
+            await send_message(ran_emoji_content(event), PRIORITY_EMOJI)
 
         print(f"✅ 已回复 {msg_type} 消息: {content}")
         print("#######################################")
@@ -206,80 +413,137 @@ async def handle_message(websocket, event):
         print(f"⚠️ [handle_message] 异常: {e}")
 
 
+# 处理单个消息事件（由调度器在会话通道内串行调用）
+async def handle_event(client, event, coalescer):
+    my_event = await special_event(event)
+    if my_event:
+        # /s img/图片
+        if isinstance(my_event, dict) and my_event.get("message"):
+            await send_message(my_event, PRIORITY_COMMAND)
+            return
+
+        # /s 群聊|私聊 <ID>
+        session_id = calc_session_id(my_event)
+
+        # 🔥 关键：如果会话未初始化，先拉取历史
+        if not memory_manager.is_session_initialized(session_id):
+            print(f"🔍 首次记忆，正在拉取历史消息...")
+            history_msgs = await get_nearby_message(client, event)
+            if history_msgs:
+                memory_manager.initialize_with_history(session_id, history_msgs)
+
+        message = my_event.get("message")
+        nickname = my_event.get("sender", {}).get("nickname", "")
+        msgs = process_single_message(message, nickname)
+
+        user_input = ""
+        for msg in reversed(msgs):
+            if msg.get("role") == "user":
+                for part in msg.get("content", []):
+                    if isinstance(part, dict) and part.get("type") == "text":
+                        user_input += part.get("text", "")
+                    if user_input:
+                        break
+
+        # 先把消息加入记忆
+        await remember(client, my_event)
+
+        # 生成回复
+        content = await ai_completion(session_id, user_input or "...")
+        await send_message(build_params("text", my_event, content))
+
+    else:
+        await remember(client, event)
+
+        # 需要回复时交给合并器，窗口内的连续触发只调用一次 LLM；私聊和被 @ 不等窗口
+        if await rep(event, memory_manager):
+            immediate = event.get("message_type") == "private" or be_atted(event)
+            coalescer.add(calc_session_id(event), event, immediate=immediate)
+
+
 async def qq_bot():
     """主连接函数"""
     async with websockets.connect(config.WEBSOCKET_URI) as ws:
         print("✅ 成功连接到WebSocket服务器")
 
+        # 所有动作都经由 client 发出，响应按 echo 回填
+        client = OneBotClient(ws)
+        client.start()
+        OUTBOUND.start(client)
+
         fortune_scheduler = setup_daily_fortune_scheduler(
-            websocket=ws,
+            outbound=OUTBOUND,
             target_groups=FORTUNE_GROUPS,
             push_hour=8,
             push_minute=0,
             theme="random"
         )
 
-        async for message in ws:
-            try:
-                event = json.loads(message)
-                # 响应"戳一戳"
-                if event.get("post_type") == "notice" and event.get("sub_type") == "poke" and event.get(
-                        "target_id") == config.SELF_USER_ID:
-                    await send_message(ws, build_params_text_only(event, ran_rep_text_only()))
-                    continue
-
-                # 过滤非消息事件
-                if event.get("post_type") != "message":
-                    continue
-
-                my_event = special_event(event)
-                if my_event:
-                    continue
-                    # /s img/图片
-                    if isinstance(my_event, dict) and my_event.get("message"):
-                        await send_message(ws, my_event)
+        # 按会话分发：同会话串行，不同会话并行
+        dispatcher = SessionDispatcher(max_concurrency=config.DISPATCH_CONCURRENCY)
+
+        # 突发合并：窗口结束后把回复任务排回该会话的通道
+        coalescer = BurstCoalescer(
+            on_fire=lambda sid, evs: dispatcher.submit(sid, lambda: handle_message(client, evs[-1], evs)),
+            window=config.BURST_WINDOW,
+            max_wait=config.BURST_MAX_WAIT,
+        )
+
+        # 定期清理过期会话，常驻内存保持平稳
+        sweeper = asyncio.create_task(memory_manager.run_sweeper(config.SESSION_SWEEP_INTERVAL))
+        flusher = asyncio.create_task(session_store.run_flusher()) if session_store is not None else None
+
+        try:
+            async for event in client.events():
+                try:
+                    # 响应"戳一戳"
+                    if event.get("post_type") == "notice" and event.get("sub_type") == "poke" and event.get(
+                            "target_id") == config.SELF_USER_ID:
+                        asyncio.create_task(send_message(build_params_text_only(event, ran_rep_text_only())))
+                        continue
+
+                    # 过滤非消息事件
+                    if event.get("post_type") != "message":
                         continue
 
-                    # /s 群聊|私聊 <ID>
-                    session_id = calc_session_id(my_event)
-
-                    # 🔥 关键：如果会话未初始化，先拉取历史
-                    if not memory_manager.is_session_initialized(session_id):
-                        print(f"🔍 首次记忆，正在拉取历史消息...")
-                        history_msgs = await get_nearby_message(ws, event, CURRENT_LLM)
-                        if history_msgs:
-                            memory_manager.initialize_with_history(session_id, history_msgs)
-
-                    message = my_event.get("message")
-                    nickname = my_event.get("sender", {}).get("nickname", "")
-                    msgs = process_single_message(message, nickname, CURRENT_LLM)
-
-                    user_input = ""
-                    for msg in reversed(msgs):
-                        if msg.get("role") == "user":
-                            for part in msg.get("content", []):
-                                if isinstance(part, dict) and part.get("type") == "text":
-                                    user_input += part.get("text", "")
-                                if user_input:
-                                    break
-
-                    # 先把消息加入记忆
-                    await remember(ws, my_event)
-
-                    # 生成回复
-                    content = await ai_completion(session_id, user_input or "...")
-                    await send_message(ws, build_params("text", my_event, content))
-
-                else:
-                    await remember(ws, event)
-
-                    if rep(event, memory_manager):
-                        await handle_message(ws, event)
-
-            except json.JSONDecodeError:
-                print("⚠️ 收到非JSON格式消息")
-            except Exception as e:
-                print(f"⚠️ 处理消息时发生错误: {e}")
+                    session_id = calc_session_id(event)
+                    dispatcher.submit(session_id, lambda ev=event: handle_event(client, ev, coalescer))
+
+                except Exception as e:
+                    print(f"⚠️ 处理消息时发生错误: {e}")
+        finally:
+            print("📊 调度统计:", dispatcher.get_stats())
+            print("📊 合并统计:", coalescer.get_stats())
+            print("📊 动作统计:", client.get_stats())
+            print("📊 发送统计:", OUTBOUND.get_stats())
+            print("📊 补全统计:", COMPLETION_STATS.snapshot())
+            print("📊 prompt tokens:", PROMPT_TOKEN_STATS.snapshot())
+            print("📊 流式首段:", STREAM_FIRST_SEGMENT_STATS.snapshot(), "总耗时:", STREAM_TOTAL_STATS.snapshot())
+            print("📊 模型对冲统计:", MODEL_RACE_STATS.get_stats())
+            print("📊 模型健康:", MODEL_HEALTH.get_stats())
+            MODEL_HEALTH.save()
+            print("📊 缓存统计:", CHAIN_REGISTRY.get_stats())
+            print("📊 图片缓存:", IMAGE_FETCHER.get_stats())
+            print("📊 图片描述缓存:", IMAGE_CAPTIONS.get_stats())
+            print("📊 图源统计:", ACG_PROVIDER_STATS.get_stats())
+            print("📊 图源候选池:", ACG_POOL.get_stats())
+            print("📊 Pixiv:", PIXIV.get_stats())
+            print("📊 媒体引用:", MEDIA.get_stats())
+            MEDIA.save()
+            ACG_POOL.save()
+            IMAGE_CAPTIONS.save()
+            print("📊 会话记忆:", memory_manager.get_stats())
+            print("📊 长期记忆检索:", memory_pool.get_stats())
+            fortune_scheduler.shutdown(wait=False)
+            sweeper.cancel()
+            if flusher is not None:
+                flusher.cancel()
+                session_store.flush()
+                print("📊 会话存储:", session_store.get_stats(), "首次回复:", WARM_START)
+            coalescer.close()
+            await dispatcher.close()
+            await OUTBOUND.stop()
+            await client.close()
 
 
 if __name__ == "__main__":